@@ -0,0 +1,85 @@
+"""
+Микробенчмарк диспетчеризации нажатий inline-кнопок
+
+Сравнивает стоимость обработки одного CallbackQuery в aiogram при цепочке
+из N обработчиков с lambda-фильтрами (как было в tg_bot) и при одном
+обработчике CallbackRouter с поиском по префиксу. Обработчики пустые,
+поэтому измеряется только выбор обработчика и разбор callback_data.
+
+Запуск: python bench/bench_callbacks.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from callbacks import CallbackRouter
+
+TOKEN = '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+ROUNDS = 2000
+
+
+def make_update(data):
+    return Update.model_validate({
+        'update_id': 1,
+        'callback_query': {
+            'id': '1', 'chat_instance': '1', 'data': data,
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'bench'},
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'bench'},
+        },
+    })
+
+
+def linear_dispatcher(count):
+    dp = Dispatcher()
+    for i in range(count):
+        prefix = f'handler{i}'
+
+        async def handler(callback_query):
+            _, page = callback_query.data.split(':')
+            int(page)
+
+        dp.callback_query.register(handler, lambda c, prefix=prefix: c.data.startswith(prefix + ':'))
+    return dp
+
+
+def router_dispatcher(count):
+    dp = Dispatcher()
+    router = CallbackRouter()
+    for i in range(count):
+        async def handler(callback_query, page):
+            pass
+
+        router.route(f'handler{i}', page=int)(handler)
+    router.attach(dp.callback_query)
+    return dp
+
+
+async def measure(dp, bot, update):
+    for _ in range(100):
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / ROUNDS * 1e6
+
+
+async def main():
+    bot = Bot(token=TOKEN)
+    print(f'{"обработчиков":>13} {"lambda, мкс":>12} {"router, мкс":>12}')
+    for count in (5, 20, 50, 100, 200):
+        # Худший случай для цепочки фильтров: совпадает последний обработчик
+        update = make_update(f'handler{count - 1}:3')
+        linear = await measure(linear_dispatcher(count), bot, update)
+        routed = await measure(router_dispatcher(count), bot, update)
+        print(f'{count:>13} {linear:>12.1f} {routed:>12.1f}')
+    await bot.session.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
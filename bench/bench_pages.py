@@ -0,0 +1,93 @@
+"""
+Бенчмарк разбиения текста на страницы
+
+Сравнивает прежнюю реализацию split_into_pages (списки строк, повторные
+strip и отдельные re.split) с текущей потоковой iter_pages на текстах в
+несколько мегабайт и проверяет, что ни одна страница не длиннее max_length.
+
+Запуск: python bench/bench_pages.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sheets_api import split_into_pages
+
+
+def reference_split_into_pages(text, max_length=4000):
+    """Прежняя реализация, оставлена для сравнения"""
+    pages = []
+    current_page = []
+    current_length = 0
+    paragraphs = re.split(r'\n\s*\n', text.strip())
+    for para in paragraphs:
+        if len(para) > max_length:
+            sentences = re.split(r'(?<=[.!?])\s+', para)
+            for sent in sentences:
+                if current_length + len(sent) + 1 > max_length:
+                    pages.append('\n'.join(current_page))
+                    current_page = []
+                    current_length = 0
+                current_page.append(sent.strip())
+                current_length += len(sent.strip()) + 1
+            if current_page:
+                pages.append('\n'.join(current_page))
+                current_page = []
+                current_length = 0
+        else:
+            if current_length + len(para) + 1 > max_length:
+                pages.append('\n'.join(current_page))
+                current_page = []
+                current_length = 0
+            current_page.append(para.strip())
+            current_length += len(para.strip()) + 1
+    if current_page:
+        pages.append('\n'.join(current_page))
+    return pages
+
+
+def make_text(size, seed=0):
+    """Текст из абзацев разной длины, в том числе длинных абзацев и предложений без точек"""
+    rng = random.Random(seed)
+    words = ['методические', 'указания', 'тест', 'вопрос', 'ответ', 'материал', 'тема', 'страница']
+    parts = []
+    total = 0
+    while total < size:
+        sentences = []
+        for _ in range(rng.choice((1, 3, 10, 60))):
+            sentence = ' '.join(rng.choice(words) for _ in range(rng.choice((5, 15, 40, 900))))
+            sentences.append(sentence.capitalize() + rng.choice('.!?'))
+        paragraph = ' '.join(sentences)
+        parts.append(paragraph)
+        total += len(paragraph) + 2
+    return '\n\n'.join(parts)
+
+
+def measure(func, text, max_length, rounds=3):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        pages = func(text, max_length)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, pages
+
+
+def main():
+    max_length = 4000
+    print(f'{"размер, МБ":>10} {"прежняя, с":>11} {"текущая, с":>11} {"страниц":>8} {"длиннее лимита (прежняя)":>25}')
+    for megabytes in (1, 4, 16):
+        text = make_text(megabytes * 1024 * 1024)
+        old_time, old_pages = measure(reference_split_into_pages, text, max_length)
+        new_time, new_pages = measure(split_into_pages, text, max_length)
+        assert all(0 < len(page) <= max_length for page in new_pages)
+        oversize = sum(len(page) > max_length or not page for page in old_pages)
+        print(f'{megabytes:>10} {old_time:>11.3f} {new_time:>11.3f} {len(new_pages):>8} {oversize:>25}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""
+Нагрузочный тест бота без сети
+
+Прогоняет синтетические сценарии пользователей через настоящий Dispatcher
+из tg_bot.bot_init: открыть меню, пролистать темы, прочитать методические
+указания, пройти тест и завершить его. Telegram заменён заглушкой сессии
+aiogram, Google Sheets - фейковым spreadsheets().values() в памяти с
+настраиваемой задержкой.
+
+Выводит p50/p95/p99 времени обработки обновления (всего и по типам
+нажатий), пропускную способность и количество запросов к Sheets и Telegram
+на один сценарий.
+
+Запуск: python bench/loadtest.py --users 200 --sheets-latency 0.2
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Настройки бота читаются при импорте tg_bot, поэтому задаются заранее
+_workdir = tempfile.mkdtemp(prefix='loadtest_')
+os.environ.setdefault('API_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+os.environ.setdefault('SPREADSHEET_ID', 'loadtest')
+os.environ.setdefault('SESSION_STORAGE', 'memory')
+os.environ.setdefault('RESULTS_SPOOL', os.path.join(_workdir, 'results_spool.jsonl'))
+os.environ.setdefault('BROADCAST_DB_PATH', os.path.join(_workdir, 'bot_state.sqlite3'))
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Message, Update
+
+from sheets_cache import topic_key
+
+
+class _Request:
+    def __init__(self, service, method, func):
+        self.service = service
+        self.method = method
+        self.func = func
+
+    def execute(self):
+        started = time.perf_counter()
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        try:
+            return self.func()
+        finally:
+            self.service.record(self.method, time.perf_counter() - started)
+
+
+class FakeSheetsService:
+    """
+    Фейковый сервис Google Sheets в памяти процесса
+
+    Поддерживает values().get / batchGet / append / update / clear. Все
+    экземпляры, созданные одной фабрикой, работают с общими данными и
+    счётчиками, как потоки пула AsyncSheets с настоящей таблицей.
+    """
+
+    def __init__(self, data, latency=0.0, stats=None, lock=None):
+        self.data = data
+        self.latency = latency
+        self.stats = stats if stats is not None else Counter()
+        self.lock = lock or threading.Lock()
+
+    def record(self, method, elapsed):
+        with self.lock:
+            self.stats[method] += 1
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _sheet(self, range_name):
+        return self.data.setdefault(range_name.split('!')[0], [])
+
+    def _read(self, range_name):
+        rows = self._sheet(range_name)
+        match = re.search(r'!A(\d+)', range_name)
+        with self.lock:
+            rows = rows[int(match.group(1)) - 1:] if match else rows[:]
+        return [list(row) for row in rows]
+
+    def get(self, spreadsheetId, range):
+        return _Request(self, 'get', lambda: {'range': range, 'values': self._read(range)})
+
+    def batchGet(self, spreadsheetId, ranges):
+        return _Request(self, 'batchGet', lambda: {
+            'valueRanges': [{'range': range_name, 'values': self._read(range_name)} for range_name in ranges]
+        })
+
+    def append(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        def append_rows():
+            rows = self._sheet(range)
+            with self.lock:
+                start = len(rows) + 1
+                rows.extend([str(value) for value in row] for row in body['values'])
+                end = len(rows)
+            return {'updates': {'updatedRows': len(body['values']),
+                                'updatedRange': f"{range.split('!')[0]}!A{start}:Z{end}"}}
+        return _Request(self, 'append', append_rows)
+
+    def update(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        return _Request(self, 'update', lambda: {'updatedCells': sum(len(row) for row in body['values'])})
+
+    def clear(self, spreadsheetId, range, body):
+        return _Request(self, 'clear', lambda: {})
+
+
+def make_sheet_data(topics, questions, variants, pages):
+    paragraph = 'Текст методического указания для нагрузочного теста. ' * 20
+    guidelines = []
+    tests = []
+    for t in range(1, topics + 1):
+        topic = f'Тема {t}'
+        guidelines.append([topic, '1', '\n\n'.join([paragraph] * (pages * 4))])
+        for _ in range(variants):
+            row = [topic]
+            for q in range(questions):
+                row += [f'Вопрос {q + 1}', 'A|B|C|D', str(random.randint(1, 4))]
+            tests.append(row)
+    return {'Лист1': guidelines, 'Лист2': tests, 'UserAnswers': []}
+
+
+class FakeSession(BaseSession):
+    """Сессия aiogram, отвечающая на запросы без обращения к Telegram"""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.stats = Counter()
+        self.last_message = {}
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.stats[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            message_id = getattr(method, 'message_id', None) or next(self._message_ids)
+            self.last_message[method.chat_id] = message_id
+            return Message.model_validate({
+                'message_id': message_id, 'date': 0, 'text': method.text,
+                'chat': {'id': method.chat_id, 'type': 'private'},
+            }, context={'bot': bot})
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(user_id, text):
+    return Update.model_validate({'update_id': next(_update_ids), 'message': {
+        'message_id': next(_update_ids), 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+    }})
+
+
+def callback_update(user_id, data, message_id):
+    return Update.model_validate({'update_id': next(_update_ids), 'callback_query': {
+        'id': str(next(_update_ids)), 'chat_instance': str(user_id), 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+        'message': {'message_id': message_id, 'date': 0, 'text': 'menu',
+                    'chat': {'id': user_id, 'type': 'private'}},
+    }})
+
+
+def journey(topics, questions):
+    """Последовательность нажатий одного пользователя"""
+    topic = f'Тема {random.randint(1, topics)}'
+    steps = ['menu_guidelines', 'guidelines_page:2', 'guidelines_page:1', f'guidelines_topic:{topic_key(topic)}',
+             'guideline_page:1', 'guideline_page:2', 'back_to_topics', 'back_previous', 'menu_testing',
+             f'testing_topic:{topic_key(topic)}']
+    for q in range(questions):
+        steps.append(f'answer:{random.randint(0, 3)}')
+        if q < questions - 1:
+            steps.append(f'question:{q + 1}')
+    steps.append('finish_test')
+    return steps
+
+
+async def run_user(bot, dp, session, user_id, args, latencies):
+    started = time.perf_counter()
+    await dp.feed_update(bot, message_update(user_id, '/start'))
+    latencies['/start'].append(time.perf_counter() - started)
+    # Дальше пользователь нажимает кнопки под сообщением с меню
+    message_id = session.last_message[user_id]
+    for data in journey(args.topics, args.questions):
+        if args.think:
+            await asyncio.sleep(random.uniform(0, 2 * args.think))
+        started = time.perf_counter()
+        await dp.feed_update(bot, callback_update(user_id, data, message_id))
+        latencies[data.split(':')[0]].append(time.perf_counter() - started)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000
+
+
+async def main(args):
+    import tg_bot
+
+    # Журнал aiogram о каждом обработанном обновлении заглушает отчёт
+    logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+    random.seed(args.seed)
+    data = make_sheet_data(args.topics, args.questions, args.variants, args.pages)
+    stats = Counter()
+    lock = threading.Lock()
+    session = FakeSession(args.telegram_latency)
+    bot, dp = tg_bot.bot_init(lambda: FakeSheetsService(data, args.sheets_latency, stats, lock), session=session)
+
+    await dp.emit_startup(bot=bot)
+    latencies = defaultdict(list)
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(bot, dp, session, user_id, args, latencies)
+                           for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    await dp.emit_shutdown(bot=bot)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    print(f'Пользователей: {args.users}, обновлений: {len(all_latencies)}, время: {elapsed:.2f} с, '
+          f'пропускная способность: {len(all_latencies) / elapsed:.0f} обновлений/с')
+    print(f'{"нажатие":>18} {"кол-во":>7} {"p50, мс":>9} {"p95, мс":>9} {"p99, мс":>9}')
+    for name, values in sorted(latencies.items()) + [('ВСЕГО', all_latencies)]:
+        print(f'{name:>18} {len(values):>7} {percentile(values, 0.5):>9.1f} '
+              f'{percentile(values, 0.95):>9.1f} {percentile(values, 0.99):>9.1f}')
+    sheets_calls = sum(stats.values())
+    telegram_calls = sum(session.stats.values())
+    print(f'Запросов к Sheets: {sheets_calls} ({dict(stats)}), на сценарий: {sheets_calls / args.users:.2f}')
+    print(f'Запросов к Telegram: {telegram_calls} ({dict(session.stats)}), на сценарий: {telegram_calls / args.users:.1f}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота с фейковыми Telegram и Google Sheets')
+    parser.add_argument('--users', type=int, default=200, help='количество одновременных пользователей')
+    parser.add_argument('--topics', type=int, default=8, help='количество тем')
+    parser.add_argument('--questions', type=int, default=10, help='вопросов в тесте')
+    parser.add_argument('--variants', type=int, default=3, help='вариантов теста на тему')
+    parser.add_argument('--pages', type=int, default=3, help='примерное количество страниц МУ на тему')
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help='задержка запроса к Sheets, с')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='задержка запроса к Telegram, с')
+    parser.add_argument('--think', type=float, default=0.0, help='средняя пауза пользователя между нажатиями, с')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='соблюдать ограничения частоты Telegram (по умолчанию сняты, чтобы мерить код бота)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    if not args.telegram_limits:
+        os.environ.setdefault('OUTBOUND_GLOBAL_RATE', '1000000')
+        os.environ.setdefault('OUTBOUND_CHAT_RATE', '1000000')
+        os.environ.setdefault('OUTBOUND_CHAT_BURST', '1000000')
+    return args
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from metrics import BROADCAST_MESSAGES
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Курсор нового задания: меньше любого ID чата
+_FIRST_CURSOR = -2 ** 63
+
+
+class UserRegistry:
+    """
+    Реестр чатов, писавших боту, и заданий рассылки в SQLite
+
+    Известные активные чаты хранятся в памяти, поэтому учёт обновления
+    выполняется проверкой по множеству. Новые чаты и чаты, заблокировавшие
+    бота, копятся и записываются пакетом при вызове flush (см. StorageFlusher).
+    Пользователь, заблокировавший бота, снова становится получателем, как
+    только напишет боту.
+
+    Args:
+        path: путь к файлу базы данных (может совпадать с SESSION_DB_PATH)
+    """
+
+    def __init__(self, path='bot_state.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'chat_id INTEGER PRIMARY KEY, blocked INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS broadcasts ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, status TEXT NOT NULL, '
+                'cursor INTEGER NOT NULL, total INTEGER NOT NULL, '
+                'sent INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, '
+                'report_chat_id INTEGER, report_message_id INTEGER, created_at REAL NOT NULL, finished_at REAL)'
+            )
+            self._active = {row[0] for row in self._conn.execute('SELECT chat_id FROM users WHERE blocked = 0')}
+        self._new = set()
+        self._blocked = set()
+
+    @property
+    def active(self):
+        """Количество чатов, которым можно отправлять рассылку"""
+        return len(self._active)
+
+    def touch(self, chat_id):
+        """Учитывает обращение чата к боту"""
+        if chat_id not in self._active:
+            self._active.add(chat_id)
+            self._blocked.discard(chat_id)
+            self._new.add(chat_id)
+
+    def mark_blocked(self, chat_id):
+        """Исключает чат из рассылок (бот заблокирован или чат удалён)"""
+        self._active.discard(chat_id)
+        self._new.discard(chat_id)
+        self._blocked.add(chat_id)
+
+    def _write_users(self, new, blocked):
+        now = time.time()
+        self._conn.executemany(
+            'INSERT INTO users (chat_id, blocked, updated_at) VALUES (?, 0, ?) '
+            'ON CONFLICT(chat_id) DO UPDATE SET blocked = 0, updated_at = excluded.updated_at',
+            [(chat_id, now) for chat_id in new])
+        self._conn.executemany(
+            'INSERT INTO users (chat_id, blocked, updated_at) VALUES (?, 1, ?) '
+            'ON CONFLICT(chat_id) DO UPDATE SET blocked = 1, updated_at = excluded.updated_at',
+            [(chat_id, now) for chat_id in blocked])
+
+    def _take_changes(self):
+        new, blocked = self._new, self._blocked
+        self._new, self._blocked = set(), set()
+        return new, blocked
+
+    def _save_users(self, new, blocked):
+        with self._lock, self._conn:
+            self._write_users(new, blocked)
+
+    async def flush(self):
+        """Записывает накопленные изменения реестра одной транзакцией"""
+        if self._new or self._blocked:
+            await asyncio.to_thread(self._save_users, *self._take_changes())
+
+    def _create_job(self, text, report_chat_id, report_message_id):
+        with self._lock, self._conn:
+            total = self._conn.execute('SELECT COUNT(*) FROM users WHERE blocked = 0').fetchone()[0]
+            cursor = self._conn.execute(
+                'INSERT INTO broadcasts (text, status, cursor, total, report_chat_id, report_message_id, created_at) '
+                "VALUES (?, 'running', ?, ?, ?, ?, ?)",
+                (text, _FIRST_CURSOR, total, report_chat_id, report_message_id, time.time()))
+            return cursor.lastrowid, total
+
+    async def create_job(self, text, report_chat_id=None, report_message_id=None):
+        """
+        Создаёт задание рассылки по всем активным чатам
+        Returns:
+            Пара (ID задания, количество получателей)
+        """
+        await self.flush()
+        return await asyncio.to_thread(self._create_job, text, report_chat_id, report_message_id)
+
+    def _next_job(self):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1").fetchone()
+        return dict(row) if row else None
+
+    async def next_job(self):
+        """Первое незавершённое задание (в том числе прерванное перезапуском) или None"""
+        return await asyncio.to_thread(self._next_job)
+
+    def _recipients(self, after, limit):
+        with self._lock:
+            rows = self._conn.execute('SELECT chat_id FROM users WHERE blocked = 0 AND chat_id > ? ORDER BY chat_id LIMIT ?',
+                                      (after, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    async def recipients(self, after, limit):
+        """Следующие limit активных чатов с ID больше after"""
+        await self.flush()
+        return await asyncio.to_thread(self._recipients, after, limit)
+
+    def _save_job(self, job, new, blocked):
+        with self._lock, self._conn:
+            self._write_users(new, blocked)
+            self._conn.execute(
+                'UPDATE broadcasts SET status = ?, cursor = ?, sent = ?, blocked = ?, failed = ?, finished_at = ? '
+                'WHERE id = ?',
+                (job['status'], job['cursor'], job['sent'], job['blocked'], job['failed'], job['finished_at'], job['id']))
+
+    async def save_job(self, job):
+        """Сохраняет прогресс задания вместе с изменениями реестра одной транзакцией"""
+        await asyncio.to_thread(self._save_job, job, *self._take_changes())
+
+    def close(self):
+        with self._lock:
+            if self._new or self._blocked:
+                with self._conn:
+                    self._write_users(*self._take_changes())
+            self._conn.close()
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения всем чатам из UserRegistry
+
+    Задания выполняются по очереди. Получатели выбираются страницами по
+    page_size в порядке ID чата и отправляются workers параллельными
+    задачами через Outbound, поэтому соблюдаются его глобальное и
+    початовое ограничения. Собственная корзина rate оставляет часть
+    глобального лимита интерактивным ответам. RetryAfter приостанавливает
+    всю рассылку на указанное время, получатель отправляется повторно.
+    Чаты, заблокировавшие бота, исключаются из реестра.
+
+    Курсор задания и счётчики сохраняются после каждой страницы, поэтому
+    после перезапуска рассылка продолжается с места остановки. При штатной
+    остановке сохраняется и незавершённая страница, при падении процесса
+    её получатели могут получить сообщение повторно.
+
+    Args:
+        outbound: экземпляр Outbound
+        registry: экземпляр UserRegistry
+        rate: сообщений рассылки в секунду
+        workers: количество одновременных запросов
+        page_size: получателей на одну сохраняемую страницу
+        report_interval: минимальный период обновления сообщения о ходе рассылки в секундах
+        max_retries: повторов одного получателя после RetryAfter
+    """
+
+    def __init__(self, outbound, registry, rate=25, workers=10, page_size=100, report_interval=5, max_retries=5):
+        self.outbound = outbound
+        self.registry = registry
+        self.workers = workers
+        self.page_size = page_size
+        self.report_interval = report_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, max(1, rate))
+        self._paused_until = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def submit(self, text, report_chat_id=None, report_message_id=None):
+        """
+        Ставит рассылку в очередь
+        Args:
+            report_chat_id, report_message_id: сообщение, в котором показывается ход рассылки
+        Returns:
+            Пара (ID задания, количество получателей)
+        """
+        job_id, total = await self.registry.create_job(text, report_chat_id, report_message_id)
+        logger.info('Рассылка #%d поставлена в очередь: %d получателей', job_id, total)
+        self._wakeup.set()
+        return job_id, total
+
+    def _pause(self, seconds):
+        # Одновременные RetryAfter от нескольких задач не складываются
+        now = time.monotonic()
+        until = now + seconds
+        if until > self._paused_until:
+            self._bucket.pause(until - max(self._paused_until, now))
+            self._paused_until = until
+
+    async def _deliver(self, chat_id, text):
+        """Отправляет сообщение одному получателю и возвращает 'sent', 'blocked' или 'failed'"""
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                await self.outbound.call(chat_id, lambda: self.outbound.bot.send_message(chat_id, text), max_retries=0)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                logger.warning('Flood control при рассылке, пауза %s с', e.retry_after)
+                self._pause(e.retry_after)
+            except TelegramForbiddenError:
+                return 'blocked'
+            except TelegramBadRequest as e:
+                if 'chat not found' in e.message:
+                    return 'blocked'
+                logger.warning('Не удалось отправить рассылку в чат %s: %s', chat_id, e)
+                return 'failed'
+            except Exception as e:
+                logger.warning('Не удалось отправить рассылку в чат %s: %s', chat_id, e)
+                return 'failed'
+        return 'failed'
+
+    async def _send_page(self, job, chat_ids):
+        results = {}
+        pending = iter(chat_ids)
+
+        async def worker():
+            for chat_id in pending:
+                results[chat_id] = await self._deliver(chat_id, job['text'])
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.workers, len(chat_ids)))))
+        finally:
+            # Курсор сдвигается только по непрерывному началу страницы: при остановке
+            # посередине страницы неотправленные получатели останутся в задании
+            for chat_id in chat_ids:
+                result = results.get(chat_id)
+                if result is None:
+                    break
+                if result == 'blocked':
+                    self.registry.mark_blocked(chat_id)
+                BROADCAST_MESSAGES.inc(result=result)
+                job[result] += 1
+                job['cursor'] = chat_id
+
+    @staticmethod
+    def progress_text(job):
+        done = job['sent'] + job['blocked'] + job['failed']
+        status = 'завершена' if job['status'] == 'done' else 'выполняется'
+        return (f"Рассылка #{job['id']} {status}: обработано {done} из {job['total']}\n"
+                f"Доставлено: {job['sent']}, заблокировали бота: {job['blocked']}, ошибок: {job['failed']}")
+
+    async def _report(self, job):
+        if job['report_chat_id'] is None:
+            return
+        try:
+            await self.outbound.edit_message_text(job['report_chat_id'], job['report_message_id'], self.progress_text(job))
+        except Exception as e:
+            logger.warning('Не удалось обновить ход рассылки #%d: %s', job['id'], e)
+
+    async def _run_job(self, job):
+        logger.info('Рассылка #%d: старт с курсора %d', job['id'], job['cursor'])
+        reported_at = 0
+        while True:
+            chat_ids = await self.registry.recipients(job['cursor'], self.page_size)
+            if not chat_ids:
+                break
+            try:
+                await self._send_page(job, chat_ids)
+            finally:
+                await self.registry.save_job(job)
+            if time.monotonic() - reported_at >= self.report_interval:
+                await self._report(job)
+                reported_at = time.monotonic()
+        job['status'] = 'done'
+        job['finished_at'] = time.time()
+        await self.registry.save_job(job)
+        await self._report(job)
+        logger.info('Рассылка #%d завершена: доставлено %d, заблокировали %d, ошибок %d',
+                    job['id'], job['sent'], job['blocked'], job['failed'])
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await self.registry.next_job()
+                if job is not None:
+                    await self._run_job(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('Ошибка рассылки: %s', e)
+                await asyncio.sleep(self.report_interval)
+                continue
+            await self._wakeup.wait()
+
+    def start(self):
+        """Запускает обработку очереди рассылок, прерванные задания продолжаются"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,81 @@
+import logging
+
+from aiogram.types import CallbackQuery
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину callback_data в байтах
+CALLBACK_DATA_LIMIT = 64
+
+
+class CallbackRouter:
+    """
+    Маршрутизатор нажатий inline-кнопок по префиксу callback_data
+
+    callback_data имеет вид '<префикс>:<поле1>:<поле2>...'. Обработчик
+    выбирается одним поиском в словаре по префиксу, поля приводятся к типам,
+    заданным при регистрации, и передаются обработчику именованными
+    аргументами. Последнее поле может содержать ':'.
+
+    Пример:
+        @callbacks.route('testing_page', page=int)
+        async def testing_page_callback(callback_query, page): ...
+    """
+
+    def __init__(self):
+        self._routes = {}
+
+    def route(self, prefix: str, **fields):
+        """Регистрирует обработчик для префикса с полями вида имя=тип"""
+        def decorator(handler):
+            if prefix in self._routes:
+                raise ValueError(f'Префикс {prefix!r} уже зарегистрирован')
+            self._routes[prefix] = (handler, tuple(fields.items()))
+            return handler
+        return decorator
+
+    def __contains__(self, prefix):
+        return prefix in self._routes
+
+    @staticmethod
+    def pack(prefix: str, *values) -> str:
+        """Собирает callback_data из префикса и значений полей"""
+        data = ':'.join((prefix, *map(str, values)))
+        if len(data.encode('utf-8')) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f'callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data!r}')
+        return data
+
+    def resolve(self, data: str):
+        """
+        Находит обработчик и разбирает поля
+        Returns:
+            Пара (обработчик, словарь полей) или None, если маршрут не найден
+        """
+        prefix, _, rest = data.partition(':')
+        route = self._routes.get(prefix)
+        if route is None:
+            return None
+        handler, fields = route
+        if not fields:
+            return handler, {}
+        values = rest.split(':', len(fields) - 1) if rest else []
+        if len(values) != len(fields):
+            return None
+        try:
+            kwargs = {name: cast(value) for (name, cast), value in zip(fields, values)}
+        except ValueError:
+            return None
+        return handler, kwargs
+
+    async def dispatch(self, callback_query: CallbackQuery):
+        resolved = self.resolve(callback_query.data or '')
+        if resolved is None:
+            logger.info('Неизвестный callback_data: %r', callback_query.data)
+            await callback_query.answer()
+            return
+        handler, kwargs = resolved
+        return await handler(callback_query, **kwargs)
+
+    def attach(self, observer):
+        """Подключает маршрутизатор единственным обработчиком, например к dp.callback_query"""
+        observer.register(self.dispatch)
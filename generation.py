@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationQueue:
+    """
+    Фоновая очередь генерации тестов
+
+    Генерация выполняется пулом из workers задач, поэтому одновременно идёт
+    не больше workers генераций и обработчики нажатий не ждут модель.
+    Повторные запросы по теме, генерация которой уже стоит в очереди или
+    выполняется, присоединяются к существующему заданию.
+
+    Args:
+        generator: асинхронная функция generator(topic), возвращающая список вопросов
+        workers: количество одновременных генераций
+    """
+
+    def __init__(self, generator, workers=2):
+        self.generator = generator
+        self.workers = workers
+        self._queue = asyncio.Queue()
+        self._jobs = {}  # тема -> список подписчиков on_done
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def is_pending(self, topic):
+        """Стоит ли генерация по теме в очереди или уже выполняется"""
+        return topic in self._jobs
+
+    def submit(self, topic, on_done=None):
+        """
+        Ставит генерацию по теме в очередь
+        Args:
+            topic: тема
+            on_done: асинхронная функция on_done(tests, error), вызывается по завершении
+        Returns:
+            True, если создано новое задание, False, если запрос присоединён к существующему
+        """
+        subscribers = self._jobs.get(topic)
+        is_new = subscribers is None
+        if is_new:
+            subscribers = self._jobs[topic] = []
+            self._queue.put_nowait(topic)
+        if on_done is not None:
+            subscribers.append(on_done)
+        return is_new
+
+    async def _run(self, topic):
+        tests, error = None, None
+        try:
+            tests = await self.generator(topic)
+        except Exception as e:
+            logger.exception('Ошибка генерации тестов по теме %s', topic)
+            error = e
+        for on_done in self._jobs.pop(topic, ()):
+            try:
+                await on_done(tests, error)
+            except Exception:
+                logger.exception('Ошибка уведомления о генерации по теме %s', topic)
+
+    async def _worker(self):
+        while True:
+            topic = await self._queue.get()
+            try:
+                await self._run(topic)
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        """Ожидает завершения всех поставленных заданий"""
+        await self._queue.join()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
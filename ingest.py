@@ -0,0 +1,284 @@
+"""
+Массовая загрузка методических указаний из каталога в Google Sheets
+
+Каждый файл *.txt становится материалом темы: для файлов в корне каталога
+тема - имя файла без расширения, для файлов во вложенных папках - имя папки
+первого уровня. Файлы читаются построчно и режутся на страницы на лету,
+страницы отправляются пакетами append ограниченного размера, несколько
+файлов обрабатываются параллельно в пределах квоты запросов AsyncSheets
+с низшим приоритетом, чтобы не мешать работающему боту.
+
+Хэши загруженных файлов и записанные ими диапазоны хранятся в файле
+состояния: неизменённые файлы пропускаются, а перед повторной загрузкой
+изменённого файла его прежние строки удаляются из листа (deleteDimension,
+а не очистка: пустые строки посреди листа сбивают поиск конца таблицы в
+append). Удаление выполняется одним запросом до начала загрузки, диапазоны
+остальных файлов в состоянии сдвигаются на число удалённых выше строк.
+Диапазон каждого пакета записывается в состояние сразу после append, а
+файл отмечается загруженным только в конце, поэтому после сбоя посередине
+файла его уже записанные строки удаляются при следующем запуске.
+
+Запуск: python ingest.py materials/ [--sheet Лист1] [--workers 4]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+
+from dotenv import load_dotenv
+
+from sheets_api import get_service, iter_pages, iter_paragraphs
+from sheets_async import PRIORITY_BULK, AsyncSheets
+
+logger = logging.getLogger(__name__)
+
+# Диапазон из updatedRange: 'Лист1'!A5:C7
+_RANGE_RE = re.compile(r'^(.*![A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$')
+
+
+def file_topic(root, path):
+    """Определяет тему файла по его положению в каталоге"""
+    parts = os.path.relpath(path, root).split(os.sep)
+    if len(parts) > 1:
+        return parts[0]
+    return os.path.splitext(parts[0])[0]
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_files(root, suffix='.txt'):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(suffix):
+                yield os.path.join(dirpath, filename)
+
+
+def range_rows(range_name):
+    """Первая и последняя строка диапазона вида Лист1!A5:C7"""
+    match = _RANGE_RE.match(range_name)
+    if match is None:
+        raise ValueError(f'Некорректный диапазон: {range_name}')
+    first = int(match.group(2))
+    return first, int(match.group(4) or first)
+
+
+def shift_range(range_name, offset):
+    """Сдвигает диапазон на offset строк вверх"""
+    match = _RANGE_RE.match(range_name)
+    first, last = range_rows(range_name)
+    if match.group(3) is None:
+        return f'{match.group(1)}{first - offset}'
+    return f'{match.group(1)}{first - offset}:{match.group(3)}{last - offset}'
+
+
+def merge_spans(spans):
+    """Объединяет пересекающиеся и соседние отрезки строк"""
+    merged = []
+    for first, last in sorted(spans):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def iter_batches(rows, max_bytes, max_rows):
+    """Группирует строки в пакеты не больше max_bytes (по UTF-8) и max_rows строк"""
+    batch = []
+    batch_bytes = 0
+    for row in rows:
+        row_bytes = sum(len(str(value).encode('utf-8')) for value in row)
+        if batch and (batch_bytes + row_bytes > max_bytes or len(batch) >= max_rows):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(row)
+        batch_bytes += row_bytes
+    if batch:
+        yield batch
+
+
+class Ingestor:
+    """
+    Загрузка каталога материалов
+
+    Args:
+        sheets: экземпляр AsyncSheets
+        spreadsheet_id: ID таблицы
+        sheet_name: имя листа с методическими указаниями
+        state_path: файл состояния с хэшами загруженных файлов
+        workers: количество файлов, обрабатываемых одновременно
+        max_batch_bytes: максимальный размер одного append
+        max_batch_rows: максимальное количество строк в одном append
+        max_length: максимальная длина страницы
+    """
+
+    def __init__(self, sheets, spreadsheet_id, sheet_name='Лист1', state_path='.ingest_state.json', workers=4,
+                 max_batch_bytes=2_000_000, max_batch_rows=500, max_length=4000):
+        self.sheets = sheets
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.state_path = state_path
+        self.workers = workers
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_rows = max_batch_rows
+        self.max_length = max_length
+        self.state = self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    def _rows(self, topic, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for idx, page in enumerate(iter_pages(iter_paragraphs(f), self.max_length), 1):
+                yield [topic, idx, page]
+
+    def _is_current(self, key, digest):
+        previous = self.state.get(key)
+        return previous is not None and previous['hash'] == digest and previous.get('complete', True)
+
+    async def delete_previous(self, keys):
+        """
+        Удаляет из листа строки прежних загрузок файлов keys одним запросом
+
+        Перед удалением диапазоны перечитываются: строки, в которых уже нет
+        темы файла (лист меняли вручную), не удаляются. Диапазоны остальных
+        файлов в состоянии сдвигаются. Нельзя вызывать во время загрузок:
+        их диапазоны ещё не записаны в состояние.
+        """
+        targets = [(key, range_name) for key in keys if key in self.state
+                   for range_name in self.state[key]['ranges']]
+        if targets:
+            data = await self.sheets.batch_get(self.spreadsheet_id, [range_name for _, range_name in targets],
+                                               priority=PRIORITY_BULK)
+            spans = []
+            for (key, range_name), rows in zip(targets, data):
+                if rows and all(row and row[0] == self.state[key]['topic'] for row in rows):
+                    spans.append(range_rows(range_name))
+                else:
+                    logger.warning('%s: строки %s изменены вне загрузки и не удаляются', key, range_name)
+            spans = merge_spans(spans)
+            if spans:
+                sheet_id = await self.sheets.get_sheet_id(self.spreadsheet_id, self.sheet_name, priority=PRIORITY_BULK)
+                await self.sheets.delete_rows(self.spreadsheet_id, sheet_id, spans, priority=PRIORITY_BULK)
+            for key in keys:
+                if key in self.state:
+                    self.state[key]['ranges'] = []
+                    self.state[key]['complete'] = False
+            for entry in self.state.values():
+                entry['ranges'] = [
+                    shift_range(range_name, sum(last - first + 1 for first, last in spans
+                                                if last < range_rows(range_name)[0]))
+                    for range_name in entry['ranges']
+                ]
+            self._save_state()
+
+    async def ingest_file(self, root, path, digest=None):
+        """
+        Загружает один файл, если он изменился с прошлой загрузки
+
+        Строки прежней версии удаляются здесь же, поэтому параллельно файлы
+        загружает только ingest, удаляющий их заранее.
+        """
+        key = os.path.relpath(path, root)
+        if digest is None:
+            digest = await asyncio.to_thread(file_hash, path)
+        if self._is_current(key, digest):
+            return 'skipped'
+
+        topic = file_topic(root, path)
+        # Удаляются строки прежней версии файла или незавершённой загрузки
+        await self.delete_previous([key])
+
+        ranges = []
+        self.state[key] = {'hash': digest, 'topic': topic, 'ranges': ranges, 'complete': False}
+        self._save_state()
+        pages = 0
+        batches = iter_batches(self._rows(topic, path), self.max_batch_bytes, self.max_batch_rows)
+        try:
+            while True:
+                # Файл читается порциями в потоке, чтобы не блокировать остальные загрузки
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                result = await self.sheets.append_rows(self.spreadsheet_id, self.sheet_name, batch,
+                                                       priority=PRIORITY_BULK)
+                ranges.append(result['updates']['updatedRange'])
+                self._save_state()
+                pages += len(batch)
+        finally:
+            batches.close()
+
+        self.state[key]['complete'] = True
+        self._save_state()
+        print(f"{key}: загружено {pages} страниц для темы '{topic}'")
+        return 'loaded'
+
+    async def ingest(self, root):
+        """Загружает все файлы каталога, возвращает счётчики loaded / skipped / failed"""
+        semaphore = asyncio.Semaphore(self.workers)
+        counters = {'loaded': 0, 'skipped': 0, 'failed': 0}
+        paths = list(iter_files(root))
+        digests = await asyncio.gather(*(asyncio.to_thread(file_hash, path) for path in paths))
+        # Строки изменённых файлов удаляются до загрузок, пока диапазоны в состоянии не меняются
+        await self.delete_previous([os.path.relpath(path, root) for path, digest in zip(paths, digests)
+                                    if not self._is_current(os.path.relpath(path, root), digest)])
+
+        async def run(path, digest):
+            async with semaphore:
+                try:
+                    counters[await self.ingest_file(root, path, digest)] += 1
+                except Exception as e:
+                    counters['failed'] += 1
+                    print(f'{path}: ошибка загрузки: {e}')
+
+        await asyncio.gather(*(run(path, digest) for path, digest in zip(paths, digests)))
+        return counters
+
+
+def main():
+    load_dotenv('.env')
+    parser = argparse.ArgumentParser(description='Загрузка методических указаний из каталога в Google Sheets')
+    parser.add_argument('root', help='каталог с файлами тем (*.txt)')
+    parser.add_argument('--spreadsheet', default=os.getenv('SPREADSHEET_ID'), help='ID таблицы')
+    parser.add_argument('--sheet', default='Лист1', help='имя листа')
+    parser.add_argument('--state', default='.ingest_state.json', help='файл состояния загрузки')
+    parser.add_argument('--workers', type=int, default=4, help='файлов одновременно')
+    parser.add_argument('--rpm', type=int, default=60, help='запросов к API в минуту')
+    parser.add_argument('--max-batch-bytes', type=int, default=2_000_000, help='максимальный размер append')
+    args = parser.parse_args()
+
+    async def run():
+        sheets = AsyncSheets(get_service, max_workers=args.workers, requests_per_minute=args.rpm)
+        try:
+            ingestor = Ingestor(sheets, args.spreadsheet, args.sheet, args.state, workers=args.workers,
+                                max_batch_bytes=args.max_batch_bytes)
+            counters = await ingestor.ingest(args.root)
+        finally:
+            sheets.close()
+        print(f"Загружено: {counters['loaded']}, без изменений: {counters['skipped']}, ошибок: {counters['failed']}")
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
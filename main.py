@@ -1,21 +1,15 @@
 import os
-from dotenv import load_dotenv
-from sheets_api import get_service, add_guidelines_from_file
-from tg_bot import bot_init, start
+from tg_bot import bot_init, start, start_webhook
 import asyncio
 
 def main():
-    #dotenv_path = '.env'
-    #load_dotenv(dotenv_path)
-    #add_guidelines_from_file(
-    #    get_service(),
-    #    spreadsheet_id=os.getenv('SPREADSHEET_ID'),
-    #    sheet_name='Лист1',
-    #    topic='Тема 1',
-    #    file_path='test.txt'
-    #)
+    # Методические указания загружаются отдельной командой: python ingest.py <каталог>
     bot, dp = bot_init()
-    asyncio.run(start(bot,dp))
+    # BOT_MODE=webhook - прием обновлений через webhook, иначе long polling
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        asyncio.run(start_webhook(bot, dp))
+    else:
+        asyncio.run(start(bot,dp))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
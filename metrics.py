@@ -0,0 +1,335 @@
+"""
+Метрики бота в формате Prometheus
+
+Счётчики и гистограммы обновляются из обработчиков и из потоков пула
+AsyncSheets, поэтому изменения защищены блокировкой. Значения
+показателей (gauge) вычисляются функциями в момент опроса.
+
+Метрики отдаются HTTP-эндпоинтом /metrics (см. start_metrics_server).
+"""
+import functools
+import logging
+import os
+import threading
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import CallbackQuery
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+_imported_at = time.monotonic()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Строки значений метрики без заголовков HELP / TYPE"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счётчики по корзинам (не накопительные), сумма и количество
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (counts[:], total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class Gauge(_Metric):
+    """Показатель, значение которого вычисляется функцией при каждом опросе"""
+    kind = 'gauge'
+
+    def set_function(self, func, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = func
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: item[0])
+        lines = []
+        for key, func in items:
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning('Не удалось вычислить %s: %s', self.name, e)
+                continue
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    """Набор метрик, отдаваемых одним эндпоинтом"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Метрика {metric.name} уже зарегистрирована')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def render(self):
+        """Текст в формате Prometheus text exposition 0.0.4"""
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+SHEETS_CALLS = REGISTRY.counter('sheets_calls_total', 'Вызовы функций sheets_api', ('function',))
+SHEETS_ERRORS = REGISTRY.counter('sheets_errors_total', 'Ошибки функций sheets_api', ('function', 'error'))
+SHEETS_RATE_LIMITED = REGISTRY.counter('sheets_rate_limited_total', 'Ответы 429 от Google Sheets API',
+                                       ('function',))
+SHEETS_LATENCY = REGISTRY.histogram('sheets_call_seconds', 'Время выполнения функций sheets_api', ('function',))
+SHEETS_ROWS = REGISTRY.counter('sheets_rows_total', 'Строки, прочитанные и записанные в Google Sheets',
+                               ('function', 'direction'))
+SHEETS_BYTES = REGISTRY.counter('sheets_bytes_total', 'Объём значений ячеек в байтах UTF-8',
+                                ('function', 'direction'))
+HANDLER_LATENCY = REGISTRY.histogram('bot_handler_seconds', 'Время обработки обновлений', ('event', 'handler'))
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', 'Исключения в обработчиках', ('event', 'handler'))
+TELEGRAM_LATENCY = REGISTRY.histogram('telegram_request_seconds', 'Время запросов к Telegram Bot API',
+                                      ('method',))
+TELEGRAM_ERRORS = REGISTRY.counter('telegram_errors_total', 'Ошибки запросов к Telegram Bot API',
+                                   ('method', 'error'))
+SHEETS_QUEUE_WAIT = REGISTRY.histogram('sheets_queue_wait_seconds', 'Ожидание запроса в очереди планировщика Sheets',
+                                       ('priority',))
+SHEETS_QUEUE_DEPTH = REGISTRY.gauge('sheets_queue_depth', 'Запросы в очереди планировщика Sheets', ('priority',))
+SHEETS_RETRIES = REGISTRY.counter('sheets_retries_total', 'Повторы запросов к Sheets после 429 / 5xx',
+                                  ('function', 'status'))
+SHEETS_READS_MERGED = REGISTRY.counter('sheets_reads_merged_total',
+                                       'Чтения, обслуженные чужим запросом (same - тот же диапазон, batch - batchGet)',
+                                       ('mode',))
+UPDATES_DEBOUNCED = REGISTRY.counter('bot_updates_debounced_total', 'Повторные нажатия, отброшенные до обработки')
+STARTUP = REGISTRY.gauge('bot_startup_seconds', 'Время от запуска процесса до этапов готовности бота', ('stage',))
+BOT_GAUGES = REGISTRY.gauge('bot_state_size', 'Размеры хранилищ и очередей бота', ('store',))
+BROADCAST_MESSAGES = REGISTRY.counter('bot_broadcast_messages_total',
+                                      'Сообщения рассылки (sent, blocked - бот заблокирован, failed)', ('result',))
+
+
+def process_uptime():
+    """Секунды с запуска процесса (по /proc в Linux, иначе с импорта этого модуля)"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Поле 22 - время запуска в тиках с загрузки системы, имя процесса в скобках может содержать пробелы
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _imported_at
+
+
+def mark_startup(stage):
+    """Запоминает и пишет в журнал время от запуска процесса до этапа stage"""
+    elapsed = process_uptime()
+    STARTUP.set_function(lambda: elapsed, stage=stage)
+    logger.info('Запуск: %s через %.2f с', stage, elapsed)
+    return elapsed
+
+
+def http_status(error):
+    """HTTP-статус ошибки googleapiclient (HttpError.resp.status) или None"""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return int(status) if status is not None else None
+
+
+def instrument_sheets(func):
+    """
+    Декоратор функций sheets_api: количество вызовов, время, ошибки и ответы 429
+
+    Применяется только к функциям, выполняющим ровно один запрос к API
+    (.execute()). Составные функции, вызывающие их, не декорируются, иначе
+    один запрос и один ответ 429 учитывались бы несколько раз.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        SHEETS_CALLS.inc(function=name)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            SHEETS_ERRORS.inc(function=name, error=type(e).__name__)
+            if http_status(e) == 429:
+                SHEETS_RATE_LIMITED.inc(function=name)
+            raise
+        finally:
+            SHEETS_LATENCY.observe(time.perf_counter() - started, function=name)
+    return wrapper
+
+
+def record_transfer(function, direction, rows):
+    """Учитывает строки и байты, переданные запросом (direction: received / sent)"""
+    SHEETS_ROWS.inc(len(rows), function=function, direction=direction)
+    SHEETS_BYTES.inc(sum(len(str(value).encode('utf-8')) for row in rows for value in row),
+                     function=function, direction=direction)
+
+
+class HandlerTimer(BaseMiddleware):
+    """
+    Middleware aiogram, измеряющий время обработчиков
+
+    Нажатия кнопок группируются по префиксу callback_data. Чтобы
+    произвольные callback_data не плодили метки, префиксы, не известные
+    маршрутизатору, учитываются как 'unknown'. Остальные обновления
+    группируются по имени обработчика. Подключается как внутренний
+    middleware: dp.callback_query.middleware(timer).
+
+    Args:
+        callbacks: CallbackRouter с зарегистрированными префиксами или None
+    """
+
+    def __init__(self, callbacks=None):
+        self.callbacks = callbacks
+
+    def _label(self, event, data):
+        if isinstance(event, CallbackQuery):
+            prefix = (event.data or '').partition(':')[0]
+            if self.callbacks is not None and prefix not in self.callbacks:
+                return 'callback_query', 'unknown'
+            return 'callback_query', prefix
+        handler = data.get('handler')
+        callback = getattr(handler, 'callback', None)
+        return type(event).__name__.lower(), getattr(callback, '__name__', 'unknown')
+
+    async def __call__(self, handler, event, data):
+        event_type, label = self._label(event, data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(event=event_type, handler=label)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, event=event_type, handler=label)
+
+
+class TelegramTimer(BaseRequestMiddleware):
+    """Middleware сессии aiogram, измеряющий запросы к Telegram: bot.session.middleware(TelegramTimer())"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error='RetryAfter' if isinstance(e, TelegramRetryAfter)
+                                else type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=name)
+
+
+async def start_metrics_server(host='127.0.0.1', port=9090, registry=REGISTRY):
+    """
+    Запускает HTTP-эндпоинт /metrics
+    Returns:
+        web.AppRunner, остановка - await runner.cleanup()
+    """
+    async def handle(request: web.Request):
+        return web.Response(body=registry.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info('Метрики доступны на http://%s:%s/metrics', host, port)
+    return runner
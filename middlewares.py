@@ -0,0 +1,97 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from metrics import UPDATES_DEBOUNCED
+
+
+class ChatSerializer(BaseMiddleware):
+    """
+    Последовательная обработка обновлений одного чата и отсев двойных нажатий
+
+    Обновления одного чата обрабатываются по очереди под блокировкой чата,
+    поэтому обработчики не меняют сессию чата одновременно. Блокировка
+    существует, только пока у чата есть обновления в обработке. Разные чаты
+    обрабатываются параллельно.
+
+    Повтор последнего нажатия на сообщении (та же кнопка) в течение
+    debounce секунд отбрасывается до обработчиков и запросов к таблицам: на него только
+    отвечается answerCallbackQuery, чтобы у кнопки пропал индикатор загрузки.
+
+    Подключается внешним middleware: dp.update.outer_middleware(ChatSerializer())
+
+    Args:
+        debounce: окно отсева одинаковых нажатий в секундах (0 - не отсеивать)
+        max_tracked: сколько последних нажатий помнить
+    """
+
+    def __init__(self, debounce=1.0, max_tracked=10000):
+        self.debounce = debounce
+        self.max_tracked = max_tracked
+        self._locks = {}  # chat_id -> [блокировка, количество обновлений в обработке]
+        self._recent = OrderedDict()  # (chat_id, сообщение) -> (callback_data, время последнего нажатия)
+
+    def _is_duplicate(self, callback_query):
+        now = time.monotonic()
+        # Нажатия упорядочены по времени, устаревшие всегда в начале
+        while self._recent:
+            _, seen = next(iter(self._recent.values()))
+            if now - seen > self.debounce or len(self._recent) > self.max_tracked:
+                self._recent.popitem(last=False)
+            else:
+                break
+        message = callback_query.message
+        key = (message.chat.id if message else callback_query.from_user.id,
+               message.message_id if message else callback_query.inline_message_id)
+        last = self._recent.pop(key, None)
+        if last is not None and last[0] == callback_query.data and now - last[1] <= self.debounce:
+            # Окно отсчитывается от первого нажатия, иначе частые повторы продлевали бы его бесконечно
+            self._recent[key] = last
+            return True
+        self._recent[key] = (callback_query.data, now)
+        return False
+
+    async def __call__(self, handler, event: Update, data):
+        callback_query = event.callback_query
+        if callback_query is not None and self.debounce and self._is_duplicate(callback_query):
+            UPDATES_DEBOUNCED.inc()
+            await data['bot'].answer_callback_query(callback_query.id)
+            return None
+
+        chat = data.get('event_chat')
+        if chat is None:
+            return await handler(event, data)
+        entry = self._locks.get(chat.id)
+        if entry is None:
+            entry = self._locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+
+class UserTracker(BaseMiddleware):
+    """
+    Учёт чатов, писавших боту, для рассылок
+
+    Подключается внешним middleware: dp.update.outer_middleware(UserTracker(registry))
+
+    Args:
+        registry: экземпляр broadcast.UserRegistry
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    async def __call__(self, handler, event: Update, data):
+        chat = data.get('event_chat')
+        if chat is not None:
+            self.registry.touch(chat.id)
+        return await handler(event, data)
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты "корзина токенов"
+
+    Токен резервируется сразу, поэтому при нехватке токенов счётчик уходит
+    в минус, а вызывающий ждёт ровно столько, сколько нужно для погашения
+    долга. Ожидающие обслуживаются в порядке обращения без блокировок.
+
+    Args:
+        rate: токенов в секунду
+        capacity: размер корзины (допустимый всплеск)
+    """
+
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Резервирует токен и возвращает время ожидания в секундах"""
+        self._refill()
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """Запрещает выдачу токенов на seconds секунд (после RetryAfter)"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class Outbound:
+    """
+    Слой исходящих запросов к Telegram
+
+    Пропускает редактирование, если текст и клавиатура сообщения совпадают
+    с последними отправленными, ограничивает частоту запросов глобально и
+    для каждого чата, а при TelegramRetryAfter ждёт указанное время и
+    повторяет запрос.
+
+    Args:
+        bot: экземпляр Bot
+        global_rate: запросов в секунду для всего бота
+        chat_rate: запросов в секунду для одного чата
+        chat_burst: допустимый всплеск запросов в одном чате
+        max_retries: количество повторов после RetryAfter
+        max_tracked: сколько чатов и сообщений помнить для ограничений и сравнения
+    """
+
+    def __init__(self, bot: Bot, global_rate=30, chat_rate=1, chat_burst=5, max_retries=3, max_tracked=10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked = max_tracked
+        self.skipped_edits = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._rendered = OrderedDict()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > self.max_tracked:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _remember(self, chat_id, message_id, fingerprint):
+        key = (chat_id, message_id)
+        self._rendered[key] = fingerprint
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > self.max_tracked:
+            self._rendered.popitem(last=False)
+
+    @staticmethod
+    def _fingerprint(text, reply_markup):
+        return hash((text, reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else None))
+
+    async def call(self, chat_id, make_request, max_retries=None):
+        """
+        Выполняет make_request() с учётом ограничений частоты и RetryAfter
+        Args:
+            max_retries: количество повторов после RetryAfter (по умолчанию self.max_retries)
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self._global.acquire()
+            try:
+                return await make_request()
+            except TelegramRetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning('Flood control в чате %s, повтор через %s с', chat_id, e.retry_after)
+                self._chat_bucket(chat_id).pause(e.retry_after)
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        msg = await self.call(chat_id, lambda: self.bot.send_message(chat_id, text, reply_markup=reply_markup, **kwargs))
+        self._remember(chat_id, msg.message_id, self._fingerprint(text, reply_markup))
+        return msg
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None, **kwargs):
+        """Редактирует сообщение, если его содержимое действительно меняется"""
+        fingerprint = self._fingerprint(text, reply_markup)
+        if self._rendered.get((chat_id, message_id)) == fingerprint:
+            self.skipped_edits += 1
+            return None
+        try:
+            result = await self.call(chat_id, lambda: self.bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup, **kwargs))
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in e.message:
+                raise
+            result = None
+        self._remember(chat_id, message_id, fingerprint)
+        return result
+
+    async def delete_message(self, chat_id, message_id):
+        self._rendered.pop((chat_id, message_id), None)
+        return await self.call(chat_id, lambda: self.bot.delete_message(chat_id, message_id))
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import hmac
+
+# Действия кнопок теста
+ACTION_GOTO = 0  # перейти к вопросу arg
+ACTION_ANSWER = 1  # выбрать вариант arg в текущем вопросе
+ACTION_SHOW = 2  # показать выбранный ответ
+ACTION_FINISH = 3  # завершить тест
+
+MAX_QUESTIONS = 256
+
+
+def answer_bits(questions):
+    """Сколько бит нужно на ответ: 0 - нет ответа, 1..N - номер варианта"""
+    return max(1, max((len(q['options']) for q in questions), default=1).bit_length())
+
+
+def _pack_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _unpack_varint(data):
+    value = 0
+    for i, byte in enumerate(data[:5]):
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, i + 1
+    raise ValueError('Некорректный номер варианта')
+
+
+def _pack_answers(answers, bits):
+    value = 0
+    for answer in reversed(answers):
+        value = (value << bits) | answer
+    return value.to_bytes((len(answers) * bits + 7) // 8, 'little')
+
+
+def _unpack_answers(data, count, bits):
+    value = int.from_bytes(data, 'little')
+    mask = (1 << bits) - 1
+    return tuple((value >> (i * bits)) & mask for i in range(count))
+
+
+class QuizCodec:
+    """
+    Состояние теста в callback_data кнопок
+
+    Сервер не хранит прохождение теста: каждая кнопка несёт номер строки
+    варианта в листе тестов, текущий вопрос, действие и ответы, упакованные
+    по answer_bits бит на вопрос. Данные подписываются усечённым HMAC,
+    в который также входят ID чата и отпечаток содержимого варианта: кнопку
+    нельзя подделать, переслать в другой чат или применить к изменённому
+    варианту. Вопросы берутся из общего банка тестов по номеру строки.
+
+    Формат (base64url без '='): varint(вариант) | вопрос | действие | аргумент | ответы | тег
+
+    Args:
+        secret: ключ HMAC
+        tag_size: длина тега в байтах
+    """
+
+    def __init__(self, secret: bytes, tag_size=6):
+        self.secret = secret
+        self.tag_size = tag_size
+
+    def _tag(self, chat_id, body, fingerprint):
+        message = b'%d:%s:' % (chat_id, fingerprint.encode('ascii')) + body
+        return hmac.new(self.secret, message, hashlib.sha256).digest()[:self.tag_size]
+
+    def pack(self, chat_id, variant, fingerprint, questions, index, answers, action, arg=0):
+        """Кодирует состояние и действие кнопки в строку для callback_data"""
+        if len(questions) > MAX_QUESTIONS or not 0 <= arg < 256:
+            raise ValueError('Тест слишком длинный для кодирования в кнопках')
+        body = (_pack_varint(variant) + bytes((index, action, arg))
+                + _pack_answers(answers, answer_bits(questions)))
+        payload = body + self._tag(chat_id, body, fingerprint)
+        return base64.urlsafe_b64encode(payload).rstrip(b'=').decode('ascii')
+
+    @staticmethod
+    def variant(token):
+        """Номер строки варианта из закодированной кнопки (до проверки подписи)"""
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return _unpack_varint(data)[0]
+
+    def unpack(self, chat_id, token, fingerprint, questions):
+        """
+        Проверяет подпись и декодирует кнопку
+        Returns:
+            Кортеж (вопрос, ответы, действие, аргумент)
+        Raises:
+            ValueError: данные повреждены, подделаны или вариант изменился
+        """
+        try:
+            data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except ValueError:
+            raise ValueError('Некорректные данные кнопки')
+        body, tag = data[:-self.tag_size], data[-self.tag_size:]
+        if not hmac.compare_digest(tag, self._tag(chat_id, body, fingerprint)):
+            raise ValueError('Подпись кнопки не совпадает')
+        _, offset = _unpack_varint(body)
+        if len(body) < offset + 3:
+            raise ValueError('Некорректные данные кнопки')
+        index, action, arg = body[offset:offset + 3]
+        bits = answer_bits(questions)
+        answers = _unpack_answers(body[offset + 3:], len(questions), bits)
+        if index >= len(questions) or any(answer > len(questions[i]['options']) for i, answer in enumerate(answers)):
+            raise ValueError('Некорректные данные кнопки')
+        return index, answers, action, arg
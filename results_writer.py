@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import os
+
+from metrics import http_status
+
+logger = logging.getLogger(__name__)
+
+
+class ResultWriter:
+    """
+    Отложенная пакетная запись результатов тестов в Google Sheets
+
+    Результат сразу дописывается в локальный файл-спул и ставится в очередь.
+    Очередь сбрасывается одним запросом append, когда набирается batch_size
+    строк или проходит flush_interval секунд. Записанные строки удаляются из
+    спула, незаписанные переживают сбои API и перезапуск бота и
+    переотправляются при старте. Доставка "не менее одного раза": при падении
+    между append и перезаписью спула строки могут продублироваться.
+
+    Если API отклоняет пакет ошибкой, которая не пройдёт при повторе (4xx,
+    кроме 429), max_attempts раз подряд, строки отправляются по одной, а
+    отклонённые переносятся в dead_letter_path, чтобы не блокировать очередь.
+
+    Args:
+        sheets: экземпляр AsyncSheets
+        spreadsheet_id: ID таблицы с результатами
+        sheet_name: имя листа с результатами
+        spool_path: путь к файлу-спулу
+        batch_size: количество строк, при котором запись начинается сразу
+        flush_interval: максимальная задержка записи в секундах
+        max_attempts: число отклонений пакета подряд до поштучной отправки
+        dead_letter_path: файл для отклонённых строк (по умолчанию спул + '.dead')
+    """
+
+    def __init__(self, sheets, spreadsheet_id, sheet_name='UserAnswers', spool_path='results_spool.jsonl',
+                 batch_size=50, flush_interval=5, max_attempts=3, dead_letter_path=None):
+        self.sheets = sheets
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path or spool_path + '.dead'
+        self._pending = []
+        self._rejected = 0
+        self._listeners = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # Дозапись и перезапись спула выполняются в потоках и не должны пересекаться
+        self._spool_lock = asyncio.Lock()
+        self._task = None
+
+    def _replay_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._pending.append(json.loads(line))
+                except ValueError:
+                    logger.warning('Пропущена повреждённая строка спула: %r', line)
+        if self._pending:
+            logger.info('Из спула восстановлено %d результатов', len(self._pending))
+        # Восстановленных строк ещё нет в таблице, слушатели узнают о них только так
+        for row in self._pending:
+            for callback in self._listeners:
+                callback(row)
+
+    @staticmethod
+    def _append_lines(path, rows):
+        with open(path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def _write_spool(path, rows):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    async def _rewrite_spool(self):
+        async with self._spool_lock:
+            await asyncio.to_thread(self._write_spool, self.spool_path, self._pending[:])
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add_listener(self, callback):
+        """Регистрирует callback(row), вызываемый для каждого нового результата"""
+        self._listeners.append(callback)
+
+    async def submit(self, row):
+        """Ставит строку результата в очередь, не дожидаясь записи в таблицу"""
+        # Сначала спул: слушатели не должны учесть результат, который может потеряться
+        async with self._spool_lock:
+            await asyncio.to_thread(self._append_lines, self.spool_path, [row])
+            self._pending.append(row)
+        for callback in self._listeners:
+            callback(row)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _write_rows_one_by_one(self, batch):
+        """Отправляет строки по одной, отклонённые переносит в dead_letter_path"""
+        rejected = []
+        done = 0
+        try:
+            for row in batch:
+                try:
+                    await self.sheets.append_rows(self.spreadsheet_id, self.sheet_name, [row])
+                except Exception as e:
+                    status = http_status(e)
+                    if status is None or not 400 <= status < 500 or status == 429:
+                        raise
+                    logger.error('Результат отклонён API (%s) и перенесён в %s: %r',
+                                 status, self.dead_letter_path, row)
+                    rejected.append(row)
+                done += 1
+        finally:
+            # Обработанные строки убираются из очереди и при сбое на середине пакета
+            if rejected:
+                await asyncio.to_thread(self._append_lines, self.dead_letter_path, rejected)
+            del self._pending[:done]
+
+    async def flush(self):
+        """Записывает накопленные строки одним запросом append"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = self._pending[:]
+            if self._rejected >= self.max_attempts:
+                try:
+                    await self._write_rows_one_by_one(batch)
+                finally:
+                    await self._rewrite_spool()
+                self._rejected = 0
+                return
+            try:
+                await self.sheets.append_rows(self.spreadsheet_id, self.sheet_name, batch)
+            except Exception as e:
+                status = http_status(e)
+                if status is not None and 400 <= status < 500 and status != 429:
+                    self._rejected += 1
+                raise
+            self._rejected = 0
+            del self._pending[:len(batch)]
+            await self._rewrite_spool()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning('Не удалось записать результаты тестов (%d в очереди): %s', len(self._pending), e)
+
+    def start(self):
+        """Восстанавливает очередь из спула и запускает фоновую запись"""
+        if self._task is None:
+            self._replay_spool()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает фоновую запись и пытается сбросить остаток очереди"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning('Результаты останутся в спуле до следующего запуска: %s', e)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import math
+import re
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+')
+
+# Окончания русских слов от длинных к коротким. Отсекается самое длинное
+# подходящее, основа сохраняет не меньше _MIN_STEM символов.
+_SUFFIXES = sorted({
+    # причастия и прилагательные
+    'ующими', 'ующего', 'ующему', 'ующих', 'ующий', 'ующая', 'ующее', 'ующие', 'ующую',
+    'ившими', 'ившего', 'ивший', 'ившая', 'ившее', 'ившие',
+    'ейшего', 'ейший', 'ейшая', 'ейшее', 'ейшие',
+    'ыми', 'ими', 'ого', 'его', 'ому', 'ему', 'ой', 'ей', 'ый', 'ий', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие',
+    'ую', 'юю', 'ых', 'их', 'ым', 'им',
+    # глаголы
+    'ировать', 'ировал', 'ирует', 'ируют', 'овать', 'евать', 'ывать', 'ивать',
+    'ать', 'ять', 'еть', 'ить', 'ыть', 'ется', 'ются', 'ится', 'ятся', 'атся', 'ться', 'тся',
+    'ает', 'яет', 'ует', 'ают', 'яют', 'уют', 'ешь', 'ишь', 'ете', 'ите', 'ала', 'ало', 'али', 'ила', 'ило',
+    'или', 'ал', 'ял', 'ил', 'ет', 'ит', 'ут', 'ют', 'ат', 'ят',
+    # существительные
+    'иями', 'ями', 'ами', 'ией', 'иям', 'иях', 'ием', 'ость', 'ости', 'остью', 'остей', 'остям', 'остях',
+    'ение', 'ения', 'ению', 'ением', 'ении', 'ений', 'ениям', 'ениях', 'ениями',
+    'ание', 'ания', 'анию', 'анием', 'ании', 'аний', 'аниям', 'аниях', 'аниями',
+    'ов', 'ев', 'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ию', 'ия', 'ие', 'ии', 'ью',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+}, key=len, reverse=True)
+_MIN_STEM = 3
+
+
+def stem(word):
+    """
+    Упрощённый стеммер для русского языка: нижний регистр, ё -> е и
+    отсечение окончания. Слова на других языках возвращаются в нижнем регистре.
+    """
+    word = word.lower().replace('ё', 'е')
+    if len(word) <= _MIN_STEM or not 'а' <= word[-1] <= 'я':
+        return word
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text):
+    """Возвращает основы слов текста (числа и слова из одной буквы отбрасываются)"""
+    return [stem(word) for word in _WORD_RE.findall(text) if len(word) > 1 and not word.isdigit()]
+
+
+class GuidelineIndex:
+    """
+    Инвертированный индекс по страницам методических указаний
+
+    Документом индекса является страница в том виде, в каком её показывает
+    show_guidelines (GuidelineCache.pages с тем же max_length), поэтому
+    найденная страница открывается по номеру без повторного разбиения.
+    Индекс сверяется с кэшем по его version и перестраивает только темы,
+    хэш содержимого которых изменился. Поиск выполняется в памяти и не
+    обращается к API.
+
+    Args:
+        cache: GuidelineCache
+        max_length: длина страницы, как в show_guidelines
+    """
+
+    def __init__(self, cache, max_length=4000):
+        self.cache = cache
+        self.max_length = max_length
+        self._postings = {}  # основа -> {(тема, страница): число вхождений}
+        self._lengths = {}  # (тема, страница) -> число слов
+        self._terms = {}  # тема -> (хэш содержимого, множество основ темы)
+        self._source_version = None
+        self._lock = asyncio.Lock()
+
+    def _remove_topic(self, topic):
+        _, terms = self._terms.pop(topic)
+        for term in terms:
+            postings = self._postings[term]
+            for doc in [doc for doc in postings if doc[0] == topic]:
+                del postings[doc]
+            if not postings:
+                del self._postings[term]
+        for doc in [doc for doc in self._lengths if doc[0] == topic]:
+            del self._lengths[doc]
+
+    def _add_topic(self, topic, content_hash, pages):
+        terms = set()
+        for page_index, page in enumerate(pages):
+            doc = (topic, page_index)
+            counts = Counter(tokenize(page))
+            self._lengths[doc] = sum(counts.values())
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[doc] = count
+            terms.update(counts)
+        self._terms[topic] = (content_hash, terms)
+
+    async def refresh(self):
+        """Приводит индекс в соответствие с кэшем, переиндексируя только изменённые темы"""
+        hashes = await self.cache.content_hashes()
+        if self.cache.version == self._source_version:
+            return
+        async with self._lock:
+            version = self.cache.version
+            if version == self._source_version:
+                return
+            changed = 0
+            for topic in [topic for topic in self._terms if topic not in hashes]:
+                self._remove_topic(topic)
+                changed += 1
+            for topic, content_hash in hashes.items():
+                indexed = self._terms.get(topic)
+                if indexed is not None and indexed[0] == content_hash:
+                    continue
+                pages = await self.cache.pages(topic, self.max_length)
+                if indexed is not None:
+                    self._remove_topic(topic)
+                self._add_topic(topic, content_hash, pages)
+                changed += 1
+            self._source_version = version
+            if changed:
+                logger.info('Поисковый индекс обновлён: тем изменено %d, страниц %d, основ %d',
+                            changed, len(self._lengths), len(self._postings))
+
+    async def search(self, query, limit=10):
+        """
+        Ищет страницы, содержащие слова запроса
+
+        Сначала идут страницы со всеми словами запроса, внутри групп - по
+        убыванию TF-IDF с нормировкой на длину страницы.
+        Returns:
+            Список пар (тема, номер страницы)
+        """
+        await self.refresh()
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        documents = len(self._lengths)
+        scores = Counter()
+        matched = Counter()
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + documents / len(postings))
+            for doc, count in postings.items():
+                scores[doc] += idf * count / math.sqrt(self._lengths[doc])
+                matched[doc] += 1
+        ranked = sorted(scores, key=lambda doc: (-matched[doc], -scores[doc], doc))
+        return ranked[:limit]
+
+
+def snippet(text, query, width=80):
+    """Фрагмент страницы вокруг первого слова из запроса"""
+    terms = set(tokenize(query))
+    start = 0
+    for match in _WORD_RE.finditer(text):
+        if stem(match.group()) in terms:
+            start = match.start()
+            break
+    start = max(0, start - width // 4)
+    fragment = ' '.join(text[start:start + width].split())
+    return ('...' if start else '') + fragment + ('...' if start + width < len(text) else '')
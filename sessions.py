@@ -0,0 +1,159 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict, deque
+
+
+class ChatSession:
+    """
+    Состояние одного чата
+
+    Attributes:
+        chat_id: ID чата
+        menu_message_id: ID сообщения с меню в этом чате
+        current_menu: текущее меню
+        menu_history: история меню для кнопки "Назад" (ограниченной длины)
+        guideline: позиция чтения МУ {'topic', 'current'} или None
+        test: сессия теста {'topic', 'questions', 'current_index', 'answers'} или None
+        last_seen: время последнего обращения (time.monotonic)
+    """
+
+    __slots__ = ('chat_id', 'menu_message_id', 'current_menu', 'menu_history',
+                 'guideline', 'test', 'last_seen')
+
+    def __init__(self, chat_id, history_size=20):
+        self.chat_id = chat_id
+        self.menu_message_id = None
+        self.current_menu = None
+        self.menu_history = deque(maxlen=history_size)
+        self.guideline = None
+        self.test = None
+        self.last_seen = time.monotonic()
+
+    def to_dict(self):
+        return {
+            'menu_message_id': self.menu_message_id,
+            'current_menu': self.current_menu,
+            'menu_history': list(self.menu_history),
+            'guideline': self.guideline,
+            'test': self.test,
+        }
+
+    @classmethod
+    def from_dict(cls, chat_id, data, history_size=20):
+        session = cls(chat_id, history_size)
+        session.menu_message_id = data.get('menu_message_id')
+        session.current_menu = data.get('current_menu')
+        session.menu_history.extend(data.get('menu_history', ()))
+        session.guideline = data.get('guideline')
+        session.test = data.get('test')
+        return session
+
+
+class SessionStore:
+    """
+    Хранилище сессий чатов с вытеснением по LRU и времени простоя
+
+    Сессии упорядочены по времени последнего обращения, поэтому устаревшие
+    всегда находятся в начале и вытесняются за O(1) на каждое обращение.
+
+    Если задан бэкенд (см. storage), память работает как кэш чтения: промах
+    дочитывает сессию из бэкенда, а сессии, к которым обращались, копятся и
+    записываются пакетом при вызове flush. Вытесненные из памяти сессии
+    остаются в бэкенде. Кэш не согласуется между процессами, поэтому при
+    нескольких процессах бота обновления одного чата должны приходить в
+    один процесс.
+
+    Args:
+        max_size: максимальное количество сессий в памяти
+        idle_ttl: время простоя в секундах, после которого сессия удаляется
+        history_size: длина истории меню в каждой сессии
+        backend: бэкенд для сохранения сессий или None
+    """
+
+    def __init__(self, max_size=10000, idle_ttl=24 * 3600, history_size=20, backend=None):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.history_size = history_size
+        self.backend = backend
+        self._sessions = OrderedDict()
+        # Изменённые с последней записи сессии: chat_id -> сессия (None - удалена)
+        self._dirty = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._sessions
+
+    @property
+    def unsaved(self):
+        """Количество изменённых сессий, ещё не записанных в бэкенд"""
+        return len(self._dirty)
+
+    def _evict(self, now):
+        while self._sessions:
+            chat_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_size or now - session.last_seen > self.idle_ttl:
+                del self._sessions[chat_id]
+                if chat_id in self._dirty and self._dirty[chat_id] is not None:
+                    # Сохраняем снимок, чтобы не потерять несохранённые изменения
+                    self._dirty[chat_id] = session.to_dict()
+            else:
+                break
+
+    def get(self, chat_id):
+        """Возвращает сессию чата, создавая её при необходимости"""
+        now = time.monotonic()
+        session = self._sessions.get(chat_id)
+        if session is None:
+            if chat_id in self._dirty:
+                # Сессия вытеснена до записи: её снимок новее копии в бэкенде
+                data = self._dirty[chat_id]
+                if isinstance(data, ChatSession):
+                    data = data.to_dict()
+            elif self.backend is not None:
+                data = self.backend.load_session(chat_id)
+            else:
+                data = None
+            if data is not None:
+                session = ChatSession.from_dict(chat_id, data, self.history_size)
+            else:
+                session = ChatSession(chat_id, self.history_size)
+            self._sessions[chat_id] = session
+        else:
+            self._sessions.move_to_end(chat_id)
+        session.last_seen = now
+        if self.backend is not None:
+            # Сессию могут изменить после получения, поэтому помечаем её к записи
+            self._dirty[chat_id] = session
+        self._evict(now)
+        return session
+
+    def peek(self, chat_id):
+        """Возвращает сессию чата без создания и без обновления времени обращения"""
+        return self._sessions.get(chat_id)
+
+    def delete(self, chat_id):
+        self._sessions.pop(chat_id, None)
+        if self.backend is not None:
+            self._dirty[chat_id] = None
+
+    async def flush(self):
+        """Записывает изменённые сессии в бэкенд одним пакетом"""
+        if not self._dirty:
+            return
+        # Сериализуем в потоке событий, пока сессии никто не меняет
+        snapshot = {}
+        for chat_id, session in self._dirty.items():
+            if isinstance(session, ChatSession):
+                session = session.to_dict()
+            snapshot[chat_id] = None if session is None else json.dumps(session, ensure_ascii=False)
+        batch, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self.backend.save_sessions, snapshot)
+        except Exception:
+            # Пакет возвращается в очередь записи, изменения, сделанные во время записи, новее
+            for chat_id, session in batch.items():
+                self._dirty.setdefault(chat_id, session)
+            raise
@@ -1,61 +1,165 @@
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
 import re
+import threading
+from datetime import datetime, timezone
+
+from metrics import instrument_sheets, record_transfer
+
+# googleapiclient и google.auth импортируются при первом обращении к API,
+# чтобы не замедлять запуск бота и команд, которым таблицы не нужны
+SERVICE_ACCOUNT_FILE = 'service_account_key.json'
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+_credentials = None
+_credentials_lock = threading.Lock()
+
+
+def get_credentials():
+    """Учётные данные сервисного аккаунта: ключ читается один раз и общий для всех сервисов"""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            from google.oauth2 import service_account
+            _credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        return _credentials
+
+
+def refresh_credentials(margin=300):
+    """
+    Обновляет токен доступа, если он отсутствует или истекает менее чем через margin секунд
+    Returns:
+        Через сколько секунд токен нужно будет обновить снова
+    """
+    import google_auth_httplib2
+    import httplib2
+
+    creds = get_credentials()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)  # google.auth хранит expiry в UTC без зоны
+    if creds.token is None or creds.expiry is None or (creds.expiry - now).total_seconds() < margin:
+        creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if creds.expiry is None:
+        return margin
+    return max(1, (creds.expiry - now).total_seconds() - margin)
+
 
 def get_service():
     """Функция для создания сервиса Google Sheets"""
-    # Используем сервисный аккаунт
-    creds = service_account.Credentials.from_service_account_file(
-        'service_account_key.json',
-        scopes=['https://www.googleapis.com/auth/spreadsheets']
-    )
+    from googleapiclient.discovery import build
 
-    service = build('sheets', 'v4', credentials=creds)
+    # Используем сервисный аккаунт, описание API берётся из копии в пакете, без запроса discovery
+    service = build('sheets', 'v4', credentials=get_credentials(), static_discovery=True, cache_discovery=False)
     return service
 
+
+_PARAGRAPH_RE = re.compile(r'\n\s*\n')
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+_WORD_RE = re.compile(r'\S+')
+
+
 def split_into_pages(text, max_length=4000):
     """Разбивает текст на страницы с учетом абзацев и предложений"""
-    pages = []
-    current_page = []
-    current_length = 0
-
     # Разбиваем на абзацы
-    paragraphs = re.split(r'\n\s*\n', text.strip())
-
+    return list(iter_pages(_PARAGRAPH_RE.split(text), max_length))
+
+
+def iter_paragraphs(lines):
+    """Собирает абзацы из потока строк (например, открытого файла), не читая его целиком"""
+    paragraph = []
+    for line in lines:
+        if line.strip():
+            paragraph.append(line.rstrip('\n'))
+        elif paragraph:
+            yield '\n'.join(paragraph)
+            paragraph = []
+    if paragraph:
+        yield '\n'.join(paragraph)
+
+
+def _wrap_words(sentence, max_length):
+    """Режет слишком длинное предложение по границам слов, слишком длинные слова - по символам"""
+    start = 0
+    end = len(sentence)
+    while end - start > max_length:
+        limit = start + max_length
+        cut = max(sentence.rfind(' ', start, limit + 1), sentence.rfind('\n', start, limit + 1))
+        if cut <= start:
+            cut = limit
+        piece = sentence[start:cut].rstrip()
+        if piece:
+            yield piece
+        start = cut
+        while start < end and sentence[start].isspace():
+            start += 1
+    if start < end:
+        yield sentence[start:]
+
+
+def _iter_segments(paragraphs, max_length):
+    """Абзацы целиком, а длинные абзацы - по предложениям, каждое не длиннее max_length"""
     for para in paragraphs:
-        if len(para) > max_length:
-            # Разбиваем длинные абзацы на предложения
-            sentences = re.split(r'(?<=[.!?])\s+', para)
-            for sent in sentences:
-                if current_length + len(sent) + 1 > max_length:
-                    pages.append('\n'.join(current_page))
-                    current_page = []
-                    current_length = 0
-                current_page.append(sent.strip())
-                current_length += len(sent.strip()) + 1
-            if current_page:
-                pages.append('\n'.join(current_page))
-                current_page = []
-                current_length = 0
-        else:
-            if current_length + len(para) + 1 > max_length:
-                pages.append('\n'.join(current_page))
-                current_page = []
-                current_length = 0
-            current_page.append(para.strip())
-            current_length += len(para.strip()) + 1
-    if current_page:
-        pages.append('\n'.join(current_page))
-    return pages
+        para = para.strip()
+        if not para:
+            continue
+        if len(para) <= max_length:
+            yield para
+            continue
+        # Разбиваем длинные абзацы на предложения
+        for sent in _SENTENCE_RE.split(para):
+            sent = sent.strip()
+            if len(sent) <= max_length:
+                if sent:
+                    yield sent
+            else:
+                yield from _wrap_words(sent, max_length)
+
+
+def iter_pages(paragraphs, max_length=4000):
+    """
+    Собирает страницы из потока абзацев по мере их поступления
 
+    Абзацы и предложения одной страницы разделяются переводом строки.
+    Каждая страница не пустая и не длиннее max_length символов.
+    """
+    page = []
+    length = 0
+    for segment in _iter_segments(paragraphs, max_length):
+        added = len(segment) + (1 if page else 0)
+        if page and length + added > max_length:
+            yield '\n'.join(page)
+            page = []
+            length = 0
+            added = len(segment)
+        page.append(segment)
+        length += added
+    if page:
+        yield '\n'.join(page)
+
+
+@instrument_sheets
 def read_sheet(service, spreadsheet_id, range_name):
     """Функция для чтения данных из таблицы"""
     sheet = service.spreadsheets()
     result = sheet.values().get(spreadsheetId=spreadsheet_id,
                                 range=range_name).execute()
     values = result.get('values', [])
+    record_transfer('read_sheet', 'received', values)
     return values
 
+@instrument_sheets
+def batch_get(service, spreadsheet_id, ranges):
+    """
+    Чтение нескольких диапазонов одним запросом values().batchGet
+    Returns:
+        Список значений для каждого диапазона в порядке ranges
+    """
+    result = service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id,
+                                                      ranges=list(ranges)).execute()
+    values = [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+    for rows in values:
+        record_transfer('batch_get', 'received', rows)
+    return values
+
+@instrument_sheets
 def add_guidelines_from_file(service, spreadsheet_id, sheet_name, topic, file_path):
     """Добавляет методическое указание из файла в таблицу"""
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -67,6 +171,7 @@ def add_guidelines_from_file(service, spreadsheet_id, sheet_name, topic, file_pa
         rows.append([topic, idx, page])
 
     body = {'values': rows}
+    record_transfer('add_guidelines_from_file', 'sent', rows)
     result = service.spreadsheets().values().append(
         spreadsheetId=spreadsheet_id,
         range=sheet_name,
@@ -75,17 +180,20 @@ def add_guidelines_from_file(service, spreadsheet_id, sheet_name, topic, file_pa
     ).execute()
     print(f"Добавлено {len(rows)} страниц для темы '{topic}'")
 
+@instrument_sheets
 def write_to_sheet(service, spreadsheet_id, range_name, values):
     """Функция для записи данных в таблицу"""
     body = {
         'values': values
     }
+    record_transfer('write_to_sheet', 'sent', values)
     result = service.spreadsheets().values().update(
         spreadsheetId=spreadsheet_id, range=range_name,
         valueInputOption='USER_ENTERED', body=body).execute()
     print(f'{result.get("updatedCells")} ячеек обновлено.')
 
 
+@instrument_sheets
 def add_row_append(service, spreadsheet_id, range_name, values):
     """
     Добавление строки в конец таблицы
@@ -99,12 +207,72 @@ def add_row_append(service, spreadsheet_id, range_name, values):
     body = {
         'values': [values]
     }
+    record_transfer('add_row_append', 'sent', [values])
     result = service.spreadsheets().values().append(
         spreadsheetId=spreadsheet_id, range=range_name,
         valueInputOption='USER_ENTERED', body=body).execute()
     print(f'Добавлено {len(values)} значений в строку {result.get("updates").get("updatedRows")}')
 
 
+@instrument_sheets
+def append_rows(service, spreadsheet_id, range_name, rows):
+    """
+    Добавление нескольких строк в конец таблицы одним запросом
+
+    Args:
+        service: сервис Google Sheets
+        spreadsheet_id: ID таблицы
+        range_name: имя листа (например, 'Лист1')
+        rows: список строк, каждая строка - список значений
+    """
+    body = {
+        'values': rows
+    }
+    record_transfer('append_rows', 'sent', rows)
+    result = service.spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id, range=range_name,
+        valueInputOption='USER_ENTERED', body=body).execute()
+    print(f'Добавлено {result.get("updates").get("updatedRows")} строк в {range_name}')
+    return result
+
+
+@instrument_sheets
+def clear_range(service, spreadsheet_id, range_name):
+    """Очищает значения в диапазоне (например, 'Лист1!A10:C20')"""
+    service.spreadsheets().values().clear(
+        spreadsheetId=spreadsheet_id, range=range_name, body={}).execute()
+    print(f'Очищен диапазон {range_name}')
+
+
+@instrument_sheets
+def get_sheet_id(service, spreadsheet_id, sheet_name):
+    """Возвращает sheetId листа по имени (нужен для запросов batchUpdate)"""
+    result = service.spreadsheets().get(spreadsheetId=spreadsheet_id,
+                                        fields='sheets.properties(sheetId,title)').execute()
+    for sheet in result.get('sheets', []):
+        if sheet['properties']['title'] == sheet_name:
+            return sheet['properties']['sheetId']
+    raise ValueError(f'Лист {sheet_name} не найден')
+
+
+@instrument_sheets
+def delete_rows(service, spreadsheet_id, sheet_id, spans):
+    """
+    Удаляет строки листа одним запросом batchUpdate, строки ниже сдвигаются вверх
+
+    Args:
+        sheet_id: sheetId листа (см. get_sheet_id)
+        spans: непересекающиеся пары (первая строка, последняя строка), нумерация с 1
+    """
+    # Удаление снизу вверх: удалённые строки не сдвигают ещё не удалённые
+    requests = [{'deleteDimension': {'range': {'sheetId': sheet_id, 'dimension': 'ROWS',
+                                               'startIndex': first - 1, 'endIndex': last}}}
+                for first, last in sorted(spans, reverse=True)]
+    service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}).execute()
+    print(f'Удалено строк: {sum(last - first + 1 for first, last in spans)}')
+
+
+@instrument_sheets
 def add_row_update(service, spreadsheet_id, range_name, values):
     """
     Обновление строки в указанной позиции
@@ -118,6 +286,7 @@ def add_row_update(service, spreadsheet_id, range_name, values):
     body = {
         'values': [values]
     }
+    record_transfer('add_row_update', 'sent', [values])
     result = service.spreadsheets().values().update(
         spreadsheetId=spreadsheet_id, range=range_name,
         valueInputOption='USER_ENTERED', body=body).execute()
@@ -147,10 +316,30 @@ def get_guidelines(service, spreadsheet_id, sheet_name, topic):
     return guidelines
 
 
+def group_guidelines(data):
+    """
+    Группирует строки листа методических указаний по темам
+    Args:
+        data: строки листа (тема, номер страницы, текст)
+
+    Returns:
+        Словарь тема -> кортеж текстов в порядке следования в таблице
+    """
+    grouped = {}
+    for row in data:
+        if len(row) >= 3:
+            grouped.setdefault(row[0].strip(), []).append(row[2].strip())
+    return {topic: tuple(texts) for topic, texts in grouped.items()}
+
+
 def generate_tests(service, spreadsheet_id, guidelines_sheet, topic):
     """Генерирует тест на основе методических материалов"""
     guidelines = get_guidelines(service, spreadsheet_id, guidelines_sheet, topic)
+    return build_tests(guidelines)
+
 
+def build_tests(guidelines):
+    """Составляет тест по уже загруженным текстам методических материалов"""
     if not guidelines:
         return []
 
@@ -173,23 +362,22 @@ def generate_tests(service, spreadsheet_id, guidelines_sheet, topic):
     return tests
 
 
-def get_tests_for_topic(service, spreadsheet_id, sheet_name, topic):
-    data = read_sheet(service, spreadsheet_id, sheet_name)
-    topic_rows = [row for row in data if row and row[0] == topic]
-
-    if not topic_rows:
-        return None
-
-    import random
-    selected_row = random.choice(topic_rows)
+def parse_test_row(row):
+    """
+    Разбирает строку листа тестов (тема, затем тройки вопрос / варианты / ответ)
+    Args:
+        row: строка листа
 
+    Returns:
+        Список вопросов в виде словарей question / options / answer
+    """
     tests = []
-    for i in range(1, len(selected_row), 3):
-        if i + 2 >= len(selected_row):
+    for i in range(1, len(row), 3):
+        if i + 2 >= len(row):
             break
-        question = selected_row[i]
-        options = selected_row[i + 1].split('|') if selected_row[i + 1] else []
-        answer = int(selected_row[i + 2]) if selected_row[i + 2].isdigit() else 0
+        question = row[i]
+        options = row[i + 1].split('|') if row[i + 1] else []
+        answer = int(row[i + 2]) if row[i + 2].isdigit() else 0
 
         tests.append({
             "question": question,
@@ -197,6 +385,19 @@ def get_tests_for_topic(service, spreadsheet_id, sheet_name, topic):
             "answer": answer
         })
     return tests
+
+
+def get_tests_for_topic(service, spreadsheet_id, sheet_name, topic):
+    data = read_sheet(service, spreadsheet_id, sheet_name)
+    topic_rows = [row for row in data if row and row[0] == topic]
+
+    if not topic_rows:
+        return None
+
+    import random
+    selected_row = random.choice(topic_rows)
+
+    return parse_test_row(selected_row)
 def write_tests_to_sheet(service, spreadsheet_id, test_sheet, topic, tests):
     row = [topic]
     for test in tests:
@@ -219,5 +420,17 @@ def write_test_results(service, spreadsheet_id, sheet_name, tg_id, topic, date,
         user_answers: ответы пользователя
         score: количество баллов
     """
-    row = [tg_id, topic, date, '|'.join(user_answers), score]
-    add_row_append(service, spreadsheet_id, sheet_name, row)
\ No newline at end of file
+    row = make_result_row(tg_id, topic, date, user_answers, score)
+    add_row_append(service, spreadsheet_id, sheet_name, row)
+
+
+def make_result_row(tg_id, topic, date, user_answers, score, correct=None):
+    """
+    Формирует строку результата теста: id, тема, дата, ответы через '|', баллы
+    и, если передана правильность ответов по вопросам, её в виде '1|0|...'
+    """
+    answers = '|'.join('' if answer is None else str(answer) for answer in user_answers)
+    row = [tg_id, topic, date, answers, score]
+    if correct is not None:
+        row.append('|'.join('1' if is_correct else '0' for is_correct in correct))
+    return row
\ No newline at end of file
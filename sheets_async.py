@@ -0,0 +1,305 @@
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sheets_api
+from metrics import SHEETS_QUEUE_DEPTH, SHEETS_QUEUE_WAIT, SHEETS_READS_MERGED, SHEETS_RETRIES, http_status
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # чтения, которых ждёт пользователь
+PRIORITY_WRITE = 1  # запись результатов
+PRIORITY_BULK = 2  # генерация тестов, массовая загрузка
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_WRITE: 'write', PRIORITY_BULK: 'bulk'}
+
+_DEFAULT_PRIORITY = {
+    sheets_api.read_sheet: PRIORITY_INTERACTIVE,
+    sheets_api.batch_get: PRIORITY_INTERACTIVE,
+    sheets_api.get_guidelines: PRIORITY_INTERACTIVE,
+    sheets_api.get_tests_for_topic: PRIORITY_INTERACTIVE,
+    sheets_api.write_test_results: PRIORITY_WRITE,
+    sheets_api.append_rows: PRIORITY_WRITE,
+    sheets_api.clear_range: PRIORITY_WRITE,
+    sheets_api.write_to_sheet: PRIORITY_WRITE,
+    sheets_api.get_sheet_id: PRIORITY_BULK,
+    sheets_api.delete_rows: PRIORITY_BULK,
+    sheets_api.generate_tests: PRIORITY_BULK,
+    sheets_api.write_tests_to_sheet: PRIORITY_BULK,
+    sheets_api.add_guidelines_from_file: PRIORITY_BULK,
+}
+
+# Запросы, которые можно повторить после 5xx: сервер мог выполнить append
+# или удаление строк, поэтому они повторяются только после 429 (запрос отклонён)
+_IDEMPOTENT = {
+    sheets_api.read_sheet,
+    sheets_api.batch_get,
+    sheets_api.get_sheet_id,
+    sheets_api.get_guidelines,
+    sheets_api.get_tests_for_topic,
+    sheets_api.generate_tests,
+    sheets_api.clear_range,
+    sheets_api.write_to_sheet,
+}
+
+# Запросы, не изменяющие таблицу: остальные сбрасывают склейку чтений
+_READS = {
+    sheets_api.read_sheet,
+    sheets_api.batch_get,
+    sheets_api.get_sheet_id,
+    sheets_api.get_guidelines,
+    sheets_api.get_tests_for_topic,
+    sheets_api.generate_tests,
+}
+
+
+def _retryable(func, status):
+    if status == 429:
+        return True
+    return status is not None and 500 <= status < 600 and func in _IDEMPOTENT
+
+
+class AsyncSheets:
+    """
+    Асинхронный доступ к Google Sheets для обработчиков бота
+
+    Вызовы googleapiclient блокирующие, поэтому выполняются в ограниченном
+    пуле потоков. httplib2 не потокобезопасен, поэтому у каждого потока пула
+    свой экземпляр сервиса, созданный service_factory.
+
+    Все запросы проходят через очередь с приоритетами и общей квотой
+    requests_per_minute: интерактивные чтения выполняются раньше записи
+    результатов, а запись результатов - раньше генерации и массовой загрузки.
+    После 429 и 5xx запрос повторяется с экспоненциальной задержкой со
+    случайным разбросом, при 429 приостанавливается выдача квоты всем.
+    Глубина очереди и время ожидания видны в метриках sheets_queue_*.
+
+    Одновременные read_sheet одного диапазона выполняются одним запросом,
+    результат получают все ожидающие. Разные диапазоны одной таблицы,
+    запрошенные в течение batch_window секунд, читаются одним batchGet.
+    Запрос на запись отменяет присоединение к уже отправленным чтениям,
+    чтобы прочитанное после записи не оказалось старше неё.
+
+    Args:
+        service_factory: функция создания сервиса Google Sheets
+        max_workers: количество потоков для запросов к таблицам
+        requests_per_minute: квота запросов к API
+        burst: сколько запросов можно выполнить подряд сверх равномерного темпа
+        max_retries: количество повторов после 429 / 5xx
+        base_delay: первая задержка повтора в секундах, дальше удваивается
+        max_delay: максимальная задержка повтора в секундах
+        batch_window: сколько секунд копить чтения для batchGet (0 - не объединять разные диапазоны)
+    """
+
+    def __init__(self, service_factory=sheets_api.get_service, max_workers=4, requests_per_minute=60, burst=10,
+                 max_retries=5, base_delay=1.0, max_delay=64.0, batch_window=0.02):
+        self._service_factory = service_factory
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._quota = TokenBucket(requests_per_minute / 60, burst)
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._dispatcher = None
+        self.batch_window = batch_window
+        # (spreadsheet_id, диапазон) -> future чтения, ещё не отправленного или выполняющегося
+        self._reads = {}
+        # spreadsheet_id -> диапазоны, ожидающие отправки одним batchGet
+        self._batches = {}
+        for priority, name in PRIORITY_NAMES.items():
+            SHEETS_QUEUE_DEPTH.set_function(lambda priority=priority: self._depth[priority], priority=name)
+
+    def _service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._service_factory()
+            self._local.service = service
+        return service
+
+    def _call(self, func, args):
+        return func(self._service(), *args)
+
+    async def warm_up(self):
+        """Заранее создаёт сервисы во всех потоках пула, чтобы первые запросы не ждали их создания"""
+        barrier = threading.Barrier(self.max_workers)
+
+        def build():
+            self._service()
+            # Держим поток занятым, пока не создадутся сервисы во всех потоках
+            try:
+                barrier.wait(timeout=5)
+            except threading.BrokenBarrierError:
+                pass
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, build) for _ in range(self.max_workers)))
+
+    def queue_depth(self):
+        """Количество запросов в очереди по приоритетам"""
+        return {PRIORITY_NAMES[priority]: depth for priority, depth in self._depth.items()}
+
+    def _enqueue(self, priority, seq, job):
+        self._depth[priority] += 1
+        job[3] = time.monotonic()
+        self._queue.put_nowait((priority, seq, job))
+
+    async def run(self, func, *args, priority=None):
+        """Выполняет func(service, *args) в пуле потоков в порядке приоритета и ожидает результат"""
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        if priority is None:
+            priority = _DEFAULT_PRIORITY.get(func, PRIORITY_WRITE)
+        if func not in _READS:
+            self._reads.clear()
+        future = asyncio.get_running_loop().create_future()
+        # Задание: функция, аргументы, future вызывающего, время постановки в очередь, номер попытки
+        self._enqueue(priority, next(self._seq), [func, args, future, None, 0])
+        return await future
+
+    async def _dispatch_loop(self):
+        slots = asyncio.Semaphore(self.max_workers)
+        while True:
+            await slots.acquire()
+            priority, seq, job = await self._queue.get()
+            self._depth[priority] -= 1
+            if job[2].done():
+                # Вызывающий уже отменил ожидание
+                slots.release()
+                continue
+            await self._quota.acquire()
+            SHEETS_QUEUE_WAIT.observe(time.monotonic() - job[3], priority=PRIORITY_NAMES[priority])
+            asyncio.create_task(self._execute(priority, seq, job, slots))
+
+    async def _execute(self, priority, seq, job, slots):
+        func, args, future, _, attempt = job
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._executor, self._call, func, args)
+        except Exception as e:
+            slots.release()
+            status = http_status(e)
+            if attempt >= self.max_retries or not _retryable(func, status):
+                if not future.done():
+                    future.set_exception(e)
+                return
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            SHEETS_RETRIES.inc(function=func.__name__, status=status)
+            logger.warning('Sheets API ответил %s на %s, повтор через %.1f с', status, func.__name__, delay)
+            if status == 429:
+                # Квота исчерпана для всех запросов, а не только для этого
+                self._quota.pause(delay)
+            await asyncio.sleep(delay)
+            job[4] = attempt + 1
+            self._enqueue(priority, seq, job)
+            return
+        slots.release()
+        if not future.done():
+            future.set_result(result)
+
+    async def read_sheet(self, spreadsheet_id, range_name):
+        key = (spreadsheet_id, range_name)
+        future = self._reads.get(key)
+        if future is not None:
+            SHEETS_READS_MERGED.inc(mode='same')
+        else:
+            future = self._reads[key] = asyncio.get_running_loop().create_future()
+            batch = self._batches.get(spreadsheet_id) if self.batch_window else None
+            # Диапазон уже есть в пакете, если после его постановки была запись: нужен новый пакет
+            if batch is None or range_name in batch:
+                batch = {}
+                if self.batch_window:
+                    self._batches[spreadsheet_id] = batch
+                asyncio.create_task(self._read_batch(spreadsheet_id, batch))
+            else:
+                SHEETS_READS_MERGED.inc(mode='batch')
+            batch[range_name] = future
+        # shield: отмена одного ожидающего не должна отменять чтение для остальных
+        return await asyncio.shield(future)
+
+    async def _read_batch(self, spreadsheet_id, batch):
+        await asyncio.sleep(self.batch_window)
+        if self._batches.get(spreadsheet_id) is batch:
+            del self._batches[spreadsheet_id]
+        ranges = list(batch)
+        results = error = None
+        try:
+            if len(ranges) == 1:
+                results = [await self.run(sheets_api.read_sheet, spreadsheet_id, ranges[0])]
+            else:
+                results = await self.run(sheets_api.batch_get, spreadsheet_id, ranges)
+        except Exception as e:
+            error = e
+        for range_name, future, values in zip(ranges, batch.values(), results or [None] * len(ranges)):
+            if self._reads.get((spreadsheet_id, range_name)) is future:
+                del self._reads[(spreadsheet_id, range_name)]
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(values)
+
+    async def batch_get(self, spreadsheet_id, ranges, priority=None):
+        return await self.run(sheets_api.batch_get, spreadsheet_id, ranges, priority=priority)
+
+    async def get_guidelines(self, spreadsheet_id, sheet_name, topic):
+        return await self.run(sheets_api.get_guidelines, spreadsheet_id, sheet_name, topic)
+
+    async def get_tests_for_topic(self, spreadsheet_id, sheet_name, topic):
+        return await self.run(sheets_api.get_tests_for_topic, spreadsheet_id, sheet_name, topic)
+
+    async def write_test_results(self, spreadsheet_id, sheet_name, tg_id, topic, date, user_answers, score):
+        return await self.run(sheets_api.write_test_results, spreadsheet_id, sheet_name,
+                              tg_id, topic, date, user_answers, score)
+
+    async def append_rows(self, spreadsheet_id, range_name, rows, priority=None):
+        return await self.run(sheets_api.append_rows, spreadsheet_id, range_name, rows, priority=priority)
+
+    async def write_to_sheet(self, spreadsheet_id, range_name, values):
+        return await self.run(sheets_api.write_to_sheet, spreadsheet_id, range_name, values)
+
+    async def clear_range(self, spreadsheet_id, range_name, priority=None):
+        return await self.run(sheets_api.clear_range, spreadsheet_id, range_name, priority=priority)
+
+    async def get_sheet_id(self, spreadsheet_id, sheet_name, priority=None):
+        return await self.run(sheets_api.get_sheet_id, spreadsheet_id, sheet_name, priority=priority)
+
+    async def delete_rows(self, spreadsheet_id, sheet_id, spans, priority=None):
+        return await self.run(sheets_api.delete_rows, spreadsheet_id, sheet_id, spans, priority=priority)
+
+    async def generate_tests(self, spreadsheet_id, guidelines_sheet, topic):
+        return await self.run(sheets_api.generate_tests, spreadsheet_id, guidelines_sheet, topic)
+
+    async def write_tests_to_sheet(self, spreadsheet_id, test_sheet, topic, tests):
+        return await self.run(sheets_api.write_tests_to_sheet, spreadsheet_id, test_sheet, topic, tests)
+
+    async def add_guidelines_from_file(self, spreadsheet_id, sheet_name, topic, file_path):
+        return await self.run(sheets_api.add_guidelines_from_file, spreadsheet_id, sheet_name, topic, file_path)
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        self._executor.shutdown(wait=False)
+
+
+async def keep_credentials_fresh(margin=300):
+    """Фоновое обновление токена доступа сервисного аккаунта за margin секунд до истечения"""
+    while True:
+        try:
+            delay = await asyncio.to_thread(sheets_api.refresh_credentials, margin)
+        except Exception as e:
+            logger.warning('Не удалось обновить токен доступа Google: %s', e)
+            delay = 30
+        await asyncio.sleep(delay)
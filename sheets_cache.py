@@ -0,0 +1,365 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from datetime import datetime
+
+from sheets_api import group_guidelines, parse_test_row, split_into_pages
+
+logger = logging.getLogger(__name__)
+
+
+class _SheetCache:
+    """
+    Общая часть кэшей листов: ленивая загрузка, сброс и фоновое обновление
+
+    Наследники реализуют _reload (полная загрузка листа) и при необходимости
+    _refresh (дозагрузка изменений после первой загрузки). Дозагрузка не
+    видит изменённых и удалённых строк, поэтому после invalidate и на каждом
+    full_reload_every-м обновлении лист перечитывается полностью.
+    """
+
+    full_reload_every = 12
+
+    def __init__(self, sheets, spreadsheet_id, sheet_name, ttl):
+        self.sheets = sheets
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.ttl = ttl
+        self.version = 0
+        self.loaded_at = None
+        self._stale = True
+        self._full_reload = True
+        self._refreshes = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def _reload(self):
+        raise NotImplementedError
+
+    async def _refresh(self):
+        await self._reload()
+
+    async def _update(self):
+        self._refreshes += 1
+        if self._full_reload or self.loaded_at is None or self._refreshes >= self.full_reload_every:
+            self._full_reload = False
+            try:
+                await self._reload()
+            except Exception:
+                self._full_reload = True
+                raise
+            self._refreshes = 0
+        else:
+            await self._refresh()
+        self._stale = False
+        self.loaded_at = time.monotonic()
+
+    async def load(self):
+        """Загружает или обновляет данные листа"""
+        async with self._lock:
+            await self._update()
+
+    async def _ensure_loaded(self):
+        if self._stale:
+            async with self._lock:
+                if self._stale:
+                    await self._update()
+
+    async def wait_loaded(self):
+        """Дожидается загрузки листа (для прогрева при запуске)"""
+        await self._ensure_loaded()
+
+    def invalidate(self):
+        """Помечает кэш устаревшим, следующий запрос перечитает лист целиком"""
+        self._stale = True
+        self._full_reload = True
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self._ensure_loaded()
+                if time.monotonic() - self.loaded_at >= self.ttl:
+                    await self.load()
+            except Exception as e:
+                logger.warning('Не удалось обновить кэш листа %s: %s', self.sheet_name, e)
+            await asyncio.sleep(self.ttl)
+
+    def start(self):
+        """Запускает фоновое обновление кэша"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class GuidelineCache(_SheetCache):
+    """
+    Кэш методических указаний в памяти с индексом тема -> тексты
+
+    Лист читается целиком один раз и затем обновляется в фоне раз в ttl
+    секунд. Поиск по теме выполняется по словарю без обращения к API.
+    Разбиение на страницы выполняется один раз для каждой пары
+    (тема, хэш содержимого, max_length) и общее для всех чатов.
+
+    Args:
+        sheets: экземпляр AsyncSheets
+        spreadsheet_id: ID таблицы
+        sheet_name: имя листа с методическими указаниями
+        ttl: период фонового обновления в секундах
+    """
+
+    def __init__(self, sheets, spreadsheet_id, sheet_name='Лист1', ttl=300):
+        super().__init__(sheets, spreadsheet_id, sheet_name, ttl)
+        self._index = {}
+        self._hashes = {}
+        self._pages = {}
+
+    async def _reload(self):
+        data = await self.sheets.read_sheet(self.spreadsheet_id, f'{self.sheet_name}!A:C')
+        index = group_guidelines(data)
+        if index != self._index:
+            self._index = index
+            self._hashes = {topic: _content_hash(texts) for topic, texts in index.items()}
+            live = set(self._hashes.items())
+            self._pages = {key: pages for key, pages in self._pages.items() if key[:2] in live}
+            self.version += 1
+
+    async def get(self, topic):
+        """Возвращает кортеж текстов по теме (пустой, если темы нет)"""
+        await self._ensure_loaded()
+        return self._index.get(topic, ())
+
+    async def pages(self, topic, max_length=4000):
+        """Возвращает кортеж страниц по теме, разбитых split_into_pages"""
+        await self._ensure_loaded()
+        texts = self._index.get(topic)
+        if not texts:
+            return ()
+        key = (topic, self._hashes[topic], max_length)
+        pages = self._pages.get(key)
+        if pages is None:
+            pages = tuple(page for text in texts for page in split_into_pages(text, max_length))
+            self._pages[key] = pages
+        return pages
+
+    async def topics(self):
+        """Возвращает темы в порядке их появления в таблице"""
+        await self._ensure_loaded()
+        return list(self._index)
+
+    async def content_hashes(self):
+        """Возвращает словарь тема -> хэш содержимого (для инкрементальных индексов)"""
+        await self._ensure_loaded()
+        return self._hashes
+
+    async def add_guidelines_from_file(self, topic, file_path):
+        """Добавляет методическое указание из файла и сбрасывает кэш"""
+        await self.sheets.add_guidelines_from_file(self.spreadsheet_id, self.sheet_name, topic, file_path)
+        self.invalidate()
+
+
+class TestBank(_SheetCache):
+    """
+    Банк тестов в памяти: тема -> список разобранных вариантов
+
+    Варианты разбираются один раз при загрузке. Последующие обновления
+    дочитывают только строки, добавленные после последней загрузки, поэтому
+    начало теста не требует обращений к API.
+
+    Args:
+        sheets: экземпляр AsyncSheets
+        spreadsheet_id: ID таблицы
+        sheet_name: имя листа с тестами
+        ttl: период фонового обновления в секундах
+    """
+
+    def __init__(self, sheets, spreadsheet_id, sheet_name='Лист2', ttl=300):
+        super().__init__(sheets, spreadsheet_id, sheet_name, ttl)
+        self._variants = {}
+        self._by_row = {}
+        self._row_count = 0
+
+    def _add_rows(self, rows, first_row):
+        for row_number, row in enumerate(rows, first_row):
+            topic = row[0].strip() if row else ''
+            if not topic:
+                continue
+            questions = tuple(parse_test_row(row))
+            if questions:
+                self._variants.setdefault(topic, []).append((row_number, questions))
+                self._by_row[row_number] = (topic, questions, _content_hash(row))
+        if rows:
+            self._row_count = first_row + len(rows) - 1
+            self.version += 1
+
+    async def _reload(self):
+        data = await self.sheets.read_sheet(self.spreadsheet_id, self.sheet_name)
+        self._variants = {}
+        self._by_row = {}
+        self._row_count = 0
+        self._add_rows(data, 1)
+
+    async def _refresh(self):
+        first_row = self._row_count + 1
+        data = await self.sheets.read_sheet(self.spreadsheet_id, f'{self.sheet_name}!A{first_row}:ZZZ')
+        self._add_rows(data, first_row)
+
+    async def pick(self, topic):
+        """
+        Возвращает случайный вариант теста по теме
+        Returns:
+            Пара (номер строки варианта, кортеж вопросов) или None
+        """
+        await self._ensure_loaded()
+        variants = self._variants.get(topic)
+        if not variants:
+            return None
+        return random.choice(variants)
+
+    async def variant(self, row_number):
+        """
+        Возвращает вариант теста по номеру строки
+        Returns:
+            Кортеж (тема, кортеж вопросов, отпечаток содержимого строки) или None
+        """
+        await self._ensure_loaded()
+        return self._by_row.get(row_number)
+
+    async def topics(self):
+        """Возвращает темы, по которым есть тесты"""
+        await self._ensure_loaded()
+        return list(self._variants)
+
+    async def write_tests(self, topic, tests):
+        """Записывает новый вариант теста и сбрасывает кэш"""
+        await self.sheets.write_tests_to_sheet(self.spreadsheet_id, self.sheet_name, topic, tests)
+        self.invalidate()
+
+
+class TopicCatalog:
+    """
+    Каталог тем, собранный из кэшей листов
+
+    Темы берутся в порядке появления в таблицах из переданных кэшей
+    (методические указания, тесты) и обновляются вместе с ними, поэтому
+    отдельных запросов к API не требуется. version меняется при каждом
+    изменении набора тем и используется как ключ для мемоизации клавиатур.
+    В кнопках тема передаётся коротким ключом topic_key, resolve находит
+    тему по ключу.
+
+    Args:
+        caches: кэши с методом topics() и атрибутом version
+    """
+
+    def __init__(self, *caches):
+        self.caches = caches
+        self._topics = ()
+        self._keys = {}
+        self._source_version = None
+        self.version = 0
+
+    async def topics(self):
+        """Возвращает кортеж тем"""
+        for cache in self.caches:
+            await cache._ensure_loaded()
+        source_version = tuple(cache.version for cache in self.caches)
+        if source_version != self._source_version:
+            self._source_version = source_version
+            topics = []
+            for cache in self.caches:
+                topics.extend(await cache.topics())
+            merged = tuple(dict.fromkeys(topics))
+            if merged != self._topics:
+                self._topics = merged
+                self._keys = {}
+                for topic in merged:
+                    self._keys.setdefault(topic_key(topic), topic)
+                self.version += 1
+        return self._topics
+
+    async def resolve(self, key):
+        """Возвращает тему по ключу topic_key или None, если такой темы больше нет"""
+        await self.topics()
+        return self._keys.get(key)
+
+
+class AttemptIndex(_SheetCache):
+    """
+    Индекс попыток прохождения тестов: (tg_id, тема) -> время последней попытки
+
+    Один раз загружается с листа результатов, далее пополняется строками,
+    которые передаёт ResultWriter, и дочитывает только новые строки листа.
+    Проверки правил пересдачи выполняются поиском по словарю.
+
+    Args:
+        sheets: экземпляр AsyncSheets
+        spreadsheet_id: ID таблицы с результатами
+        sheet_name: имя листа с результатами
+        ttl: период фонового обновления в секундах
+    """
+
+    date_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, sheets, spreadsheet_id, sheet_name='UserAnswers', ttl=300):
+        super().__init__(sheets, spreadsheet_id, sheet_name, ttl)
+        self._last = {}
+        self._row_count = 0
+
+    def record(self, row):
+        """Учитывает строку результата (tg_id, тема, дата, ...)"""
+        if len(row) < 3:
+            return
+        try:
+            attempted_at = datetime.strptime(str(row[2]), self.date_format)
+        except ValueError:
+            return
+        key = (str(row[0]), row[1])
+        last = self._last.get(key)
+        if last is None or attempted_at > last:
+            self._last[key] = attempted_at
+
+    def _add_rows(self, rows, first_row):
+        for row in rows:
+            self.record(row)
+        if rows:
+            self._row_count = first_row + len(rows) - 1
+            self.version += 1
+
+    async def _reload(self):
+        data = await self.sheets.read_sheet(self.spreadsheet_id, f'{self.sheet_name}!A:E')
+        # Строки листа сливаются с уже учтёнными (record берёт максимум по ключу): попытки из
+        # спула ResultWriter, переданные до первой загрузки, могли ещё не попасть в таблицу
+        self._row_count = 0
+        self._add_rows(data, 1)
+
+    async def _refresh(self):
+        first_row = self._row_count + 1
+        data = await self.sheets.read_sheet(self.spreadsheet_id, f'{self.sheet_name}!A{first_row}:E')
+        self._add_rows(data, first_row)
+
+    async def last_attempt(self, tg_id, topic):
+        """Возвращает время последней попытки или None"""
+        await self._ensure_loaded()
+        return self._last.get((str(tg_id), topic))
+
+
+def topic_key(topic):
+    """Короткий стабильный ключ темы для callback_data (название темы может не уместиться в 64 байта)"""
+    return hashlib.sha1(topic.encode('utf-8')).hexdigest()[:10]
+
+
+def _content_hash(texts):
+    digest = hashlib.sha1()
+    for text in texts:
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class TopicStats:
+    """Агрегаты результатов по одной теме"""
+
+    __slots__ = ('attempts', 'score_sum', 'question_sum', 'passed', 'scores', 'question_correct', 'question_total')
+
+    def __init__(self):
+        self.attempts = 0
+        self.score_sum = 0
+        self.question_sum = 0
+        self.passed = 0
+        self.scores = Counter()  # баллы -> количество попыток
+        self.question_correct = []  # номер вопроса -> верных ответов
+        self.question_total = []  # номер вопроса -> попыток с известной правильностью
+
+    def add(self, score, questions, correct, passed):
+        self.attempts += 1
+        self.score_sum += score
+        self.question_sum += questions
+        self.passed += passed
+        self.scores[score] += 1
+        if correct:
+            missing = len(correct) - len(self.question_total)
+            if missing > 0:
+                self.question_correct.extend([0] * missing)
+                self.question_total.extend([0] * missing)
+            for i, is_correct in enumerate(correct):
+                self.question_total[i] += 1
+                self.question_correct[i] += is_correct
+
+    @property
+    def average(self):
+        return self.score_sum / self.attempts if self.attempts else 0
+
+    @property
+    def percent(self):
+        return 100 * self.score_sum / self.question_sum if self.question_sum else 0
+
+    @property
+    def pass_rate(self):
+        return 100 * self.passed / self.attempts if self.attempts else 0
+
+    def question_rates(self):
+        """Доля верных ответов по вопросам в процентах (None - нет данных)"""
+        return [100 * correct / total if total else None
+                for correct, total in zip(self.question_correct, self.question_total)]
+
+
+class ScoreStats:
+    """
+    Статистика результатов тестов по темам в памяти
+
+    Один раз загружается с листа результатов, далее пополняется строками,
+    которые передаёт ResultWriter, поэтому ответ на запрос статистики не
+    зависит от количества попыток. Раз в flush_interval секунд сводка
+    записывается на отдельный лист одним запросом update.
+
+    Строки, пришедшие до окончания первой загрузки, могли уже попасть в
+    таблицу, поэтому учитываются, только если их нет среди последних
+    строк листа.
+
+    Args:
+        sheets: экземпляр AsyncSheets
+        spreadsheet_id: ID таблицы с результатами и сводкой
+        results_sheet: имя листа с результатами
+        summary_sheet: имя листа сводки (лист должен существовать)
+        pass_ratio: доля верных ответов, с которой тест считается сданным
+        flush_interval: период записи сводки в секундах
+    """
+
+    summary_header = ['Тема', 'Попыток', 'Средний балл', 'Верных ответов, %', 'Сдали, %',
+                      'Распределение баллов', 'Верных по вопросам, %']
+
+    def __init__(self, sheets, spreadsheet_id, results_sheet='UserAnswers', summary_sheet='Stats', pass_ratio=0.6,
+                 flush_interval=300):
+        self.sheets = sheets
+        self.spreadsheet_id = spreadsheet_id
+        self.results_sheet = results_sheet
+        self.summary_sheet = summary_sheet
+        self.pass_ratio = pass_ratio
+        self.flush_interval = flush_interval
+        self.version = 0
+        self._topics = {}
+        self._loaded = False
+        self._early = []
+        self._lock = asyncio.Lock()
+        self._flushed_version = 0
+        self._flushed_rows = 0
+        self._task = None
+
+    def _parse(self, row):
+        """Строка результата (tg_id, тема, дата, ответы, баллы[, правильность]) -> (тема, баллы, вопросов, правильность)"""
+        if len(row) < 5 or not row[1]:
+            return None
+        try:
+            score = int(row[4])
+        except ValueError:
+            return None
+        correct = [flag == '1' for flag in str(row[5]).split('|')] if len(row) > 5 and row[5] != '' else []
+        questions = len(correct) or len(str(row[3]).split('|'))
+        return row[1], score, questions, correct
+
+    def _apply(self, row):
+        parsed = self._parse(row)
+        if parsed is None:
+            return
+        topic, score, questions, correct = parsed
+        stats = self._topics.get(topic)
+        if stats is None:
+            stats = self._topics[topic] = TopicStats()
+        stats.add(score, questions, correct, score >= self.pass_ratio * questions)
+        self.version += 1
+
+    def record(self, row):
+        """Учитывает строку нового результата (слушатель ResultWriter)"""
+        if self._loaded:
+            self._apply(row)
+        else:
+            self._early.append(row)
+
+    async def load(self):
+        """Загружает агрегаты с листа результатов (один раз)"""
+        async with self._lock:
+            if self._loaded:
+                return
+            data = await self.sheets.read_sheet(self.spreadsheet_id, f'{self.results_sheet}!A:F')
+            for row in data:
+                self._apply(row)
+            # Ранние строки, которые успели записаться, уже учтены в data
+            tail = Counter(tuple(str(value) for value in row[:5]) for row in data[-(10 * len(self._early) + 100):])
+            for row in self._early:
+                key = tuple(str(value) for value in row[:5])
+                if tail[key]:
+                    tail[key] -= 1
+                else:
+                    self._apply(row)
+            self._early = []
+            self._loaded = True
+            logger.info('Статистика загружена: %d попыток по %d темам',
+                        sum(stats.attempts for stats in self._topics.values()), len(self._topics))
+
+    async def topics(self):
+        """Возвращает словарь тема -> TopicStats"""
+        await self.load()
+        return self._topics
+
+    def summary_rows(self):
+        """Таблица сводки: заголовок и строка на каждую тему"""
+        rows = [self.summary_header]
+        for topic, stats in self._topics.items():
+            rows.append([
+                topic, stats.attempts, round(stats.average, 2), round(stats.percent, 1), round(stats.pass_rate, 1),
+                ' '.join(f'{score}:{count}' for score, count in sorted(stats.scores.items())),
+                ' '.join('-' if rate is None else f'{rate:.0f}' for rate in stats.question_rates()),
+            ])
+        return rows
+
+    async def flush(self):
+        """Записывает сводку одним запросом, если статистика изменилась"""
+        if not self._loaded or self.version == self._flushed_version:
+            return
+        version = self.version
+        rows = self.summary_rows()
+        written = len(rows)
+        # Строки тем, исчезнувших со времени прошлой записи, затираются пустыми
+        rows += [[''] * len(self.summary_header)] * max(0, self._flushed_rows - len(rows))
+        await self.sheets.write_to_sheet(self.spreadsheet_id, f'{self.summary_sheet}!A1', rows)
+        self._flushed_version = version
+        self._flushed_rows = written
+
+    async def _flush_loop(self):
+        try:
+            await self.load()
+        except Exception as e:
+            logger.warning('Не удалось загрузить статистику: %s', e)
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.load()
+                await self.flush()
+            except Exception as e:
+                logger.warning('Не удалось записать сводку статистики: %s', e)
+
+    def start(self):
+        """Загружает статистику в фоне и запускает периодическую запись сводки"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning('Не удалось записать сводку статистики при остановке: %s', e)
+
+
+def format_overview(topics, limit=4000):
+    """Краткая статистика по всем темам для сообщения"""
+    if not topics:
+        return 'Результатов пока нет'
+    lines = ['Статистика по темам:']
+    for topic, stats in sorted(topics.items(), key=lambda item: -item[1].attempts):
+        line = (f'{topic}: {stats.attempts} попыток, средний балл {stats.average:.1f} '
+                f'({stats.percent:.0f}%), сдали {stats.pass_rate:.0f}%')
+        if sum(map(len, lines)) + len(lines) + len(line) > limit:
+            lines.append('...')
+            break
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def format_topic(topic, stats):
+    """Подробная статистика по теме: распределение баллов и самые трудные вопросы"""
+    if stats is None:
+        return f"По теме '{topic}' результатов нет"
+    lines = [f'{topic}', f'Попыток: {stats.attempts}', f'Средний балл: {stats.average:.2f} ({stats.percent:.0f}%)',
+             f'Сдали: {stats.pass_rate:.0f}%', 'Распределение баллов:']
+    lines += [f'  {score}: {count}' for score, count in sorted(stats.scores.items())]
+    rates = [(rate, i) for i, rate in enumerate(stats.question_rates()) if rate is not None]
+    if rates:
+        lines.append('Самые трудные вопросы:')
+        lines += [f'  Вопрос {i + 1}: {rate:.0f}% верных' for rate, i in sorted(rates)[:5]]
+    return '\n'.join(lines)
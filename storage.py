@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """Бэкенд без сохранения: состояние живёт только в памяти процесса"""
+
+    def load_session(self, chat_id):
+        return None
+
+    def save_sessions(self, sessions):
+        pass
+
+    def load_fsm(self, key):
+        return None
+
+    def save_fsm(self, records):
+        pass
+
+    def prune(self, older_than):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """
+    Встроенное хранилище состояния в SQLite в режиме WAL
+
+    Не требует внешнего сервиса. Чтение при промахе кэша выполняется в
+    потоке событий через отдельное соединение без блокировки: в режиме WAL
+    читатель не ждёт транзакцию записи, поэтому пакетная запись в потоке
+    StorageFlusher не задерживает обработку нажатий. Соединение записи
+    защищено блокировкой.
+
+    Args:
+        path: путь к файлу базы данных
+    """
+
+    def __init__(self, path='bot_state.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS fsm ('
+                'key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+        # Используется только из потока событий
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+
+    def load_session(self, chat_id):
+        row = self._reader.execute('SELECT data FROM sessions WHERE chat_id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_sessions(self, sessions):
+        """Сохраняет пакет сессий (chat_id -> JSON) одной транзакцией, None удаляет сессию"""
+        now = time.time()
+        saved = [(chat_id, data, now)
+                 for chat_id, data in sessions.items() if data is not None]
+        deleted = [(chat_id,) for chat_id, data in sessions.items() if data is None]
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO sessions (chat_id, data, updated_at) VALUES (?, ?, ?)', saved)
+            self._conn.executemany('DELETE FROM sessions WHERE chat_id = ?', deleted)
+
+    def load_fsm(self, key):
+        row = self._reader.execute('SELECT state, data FROM fsm WHERE key = ?', (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def save_fsm(self, records):
+        """Сохраняет пакет записей FSM вида key -> (state, data)"""
+        now = time.time()
+        rows = [(key, state, json.dumps(data, ensure_ascii=False), now) for key, (state, data) in records.items()]
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)', rows)
+
+    def prune(self, older_than):
+        """Удаляет сессии, не обновлявшиеся с момента older_than (time.time)"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM sessions WHERE updated_at < ?', (older_than,))
+
+    def close(self):
+        self._reader.close()
+        with self._lock:
+            self._conn.close()
+
+
+def create_backend(kind, path):
+    """Создаёт бэкенд по имени: 'sqlite' или 'memory'"""
+    if kind == 'sqlite':
+        return SQLiteBackend(path)
+    if kind == 'memory':
+        return MemoryBackend()
+    raise ValueError(f'Неизвестный тип хранилища: {kind}')
+
+
+class BackendFSMStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram поверх бэкенда с кэшем чтения в памяти
+
+    Чтение обслуживается из памяти, промах дочитывает запись из бэкенда.
+    Изменения копятся и записываются пакетом при вызове flush. Записи в
+    памяти вытесняются по LRU и времени простоя, как сессии в SessionStore:
+    aiogram читает состояние на каждом обновлении, без вытеснения в памяти
+    остался бы каждый, кто когда-либо писал боту.
+
+    Кэш не согласуется между процессами: при нескольких процессах бота с
+    общей базой обновления одного чата должны приходить в один процесс
+    (маршрутизация по chat_id), иначе процесс может прочитать устаревшее
+    состояние из своей памяти.
+
+    Args:
+        backend: бэкенд хранилища
+        max_size: максимальное количество записей в памяти
+        idle_ttl: время простоя в секундах, после которого запись вытесняется из памяти
+    """
+
+    def __init__(self, backend, max_size=10000, idle_ttl=24 * 3600):
+        self.backend = backend
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._records = OrderedDict()  # ключ -> [(state, data), время последнего обращения]
+        # Изменённые с последней записи: ключ -> (state, data), переживают вытеснение из памяти
+        self._dirty = {}
+
+    @property
+    def cached(self):
+        """Количество записей в памяти (не __len__: пустое хранилище не должно быть ложным для Dispatcher)"""
+        return len(self._records)
+
+    @staticmethod
+    def _key(key):
+        return ':'.join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                                key.business_connection_id, key.destiny))
+
+    def _evict(self, now):
+        while self._records:
+            _, (_, seen) = next(iter(self._records.items()))
+            if len(self._records) > self.max_size or now - seen > self.idle_ttl:
+                self._records.popitem(last=False)
+            else:
+                break
+
+    def _record(self, key):
+        record_key = self._key(key)
+        now = time.monotonic()
+        entry = self._records.get(record_key)
+        if entry is None:
+            record = self._dirty.get(record_key)
+            if record is None:
+                record = self.backend.load_fsm(record_key) or (None, {})
+            entry = self._records[record_key] = [record, now]
+            self._evict(now)
+        else:
+            entry[1] = now
+            self._records.move_to_end(record_key)
+        return record_key, entry[0]
+
+    def _store(self, record_key, record):
+        self._records[record_key][0] = record
+        self._dirty[record_key] = record
+
+    async def set_state(self, key, state=None):
+        record_key, (_, data) = self._record(key)
+        self._store(record_key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key):
+        return self._record(key)[1][0]
+
+    async def set_data(self, key, data):
+        record_key, (state, _) = self._record(key)
+        self._store(record_key, (state, dict(data)))
+
+    async def get_data(self, key):
+        return dict(self._record(key)[1][1])
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        records, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self.backend.save_fsm, records)
+        except Exception:
+            for record_key, record in records.items():
+                self._dirty.setdefault(record_key, record)
+            raise
+
+    async def close(self):
+        await self.flush()
+
+
+class StorageFlusher:
+    """
+    Периодическая пакетная запись состояния в бэкенд
+
+    Args:
+        backend: бэкенд хранилища
+        stores: объекты с асинхронным методом flush (SessionStore, BackendFSMStorage)
+        interval: период записи в секундах
+        idle_ttl: сессии старше этого времени удаляются из бэкенда
+    """
+
+    def __init__(self, backend, stores, interval=1.0, idle_ttl=None):
+        self.backend = backend
+        self.stores = stores
+        self.interval = interval
+        self.idle_ttl = idle_ttl
+        self._task = None
+
+    async def flush(self):
+        for store in self.stores:
+            await store.flush()
+
+    async def _flush_loop(self):
+        last_prune = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+                if self.idle_ttl and time.monotonic() - last_prune > self.idle_ttl / 24:
+                    await asyncio.to_thread(self.backend.prune, time.time() - self.idle_ttl)
+                    last_prune = time.monotonic()
+            except Exception as e:
+                logger.warning('Не удалось сохранить состояние бота: %s', e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self.backend.close()
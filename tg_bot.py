@@ -1,23 +1,218 @@
 import os
+import hashlib
+import hmac
+import secrets
+import signal
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 import logging
+import asyncio
 from datetime import datetime, timedelta
-from sheets_api import get_service, get_guidelines, write_tests_to_sheet, generate_tests, write_test_results, read_sheet, split_into_pages, get_tests_for_topic
+import sheets_api
+from sheets_api import get_service, make_result_row, build_tests
+from sheets_async import AsyncSheets, keep_credentials_fresh
+from sheets_cache import GuidelineCache, TestBank, AttemptIndex, TopicCatalog, topic_key
+from results_writer import ResultWriter
+from sessions import SessionStore
+from storage import BackendFSMStorage, StorageFlusher, create_backend
+from callbacks import CallbackRouter
+from generation import GenerationQueue
+from outbound import Outbound
+from middlewares import ChatSerializer, UserTracker
+from broadcast import Broadcaster, UserRegistry
+from stats import ScoreStats, format_overview, format_topic
+from search import GuidelineIndex, snippet
+from quiz import ACTION_ANSWER, ACTION_FINISH, ACTION_GOTO, ACTION_SHOW, QuizCodec
+from metrics import BOT_GAUGES, HandlerTimer, TelegramTimer, mark_startup, start_metrics_server
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardButton, Message, CallbackQuery
+from aiogram.types import InlineKeyboardButton, Message, CallbackQuery, Update
+from aiohttp import web
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 dotenv_path = '.env'
 load_dotenv(dotenv_path)
 token = os.getenv('API_TOKEN')
 spreadsheet = os.getenv('SPREADSHEET_ID')
+sheets_workers = int(os.getenv('SHEETS_WORKERS', '4'))
+# Квота запросов к Google Sheets API на сервисный аккаунт
+sheets_requests_per_minute = float(os.getenv('SHEETS_REQUESTS_PER_MINUTE', '60'))
+sheets_burst = int(os.getenv('SHEETS_BURST', '10'))
+# Сколько секунд копить одновременные чтения разных диапазонов для одного batchGet
+sheets_batch_window = float(os.getenv('SHEETS_BATCH_WINDOW', '0.02'))
+guidelines_ttl = int(os.getenv('GUIDELINES_TTL', '300'))
+tests_ttl = int(os.getenv('TESTS_TTL', '300'))
+results_spreadsheet = os.getenv('RESULTS_SPREADSHEET_ID', spreadsheet)
+results_sheet = os.getenv('RESULTS_SHEET', 'UserAnswers')
+results_spool = os.getenv('RESULTS_SPOOL', 'results_spool.jsonl')
+results_batch_size = int(os.getenv('RESULTS_BATCH_SIZE', '50'))
+results_flush_interval = float(os.getenv('RESULTS_FLUSH_INTERVAL', '5'))
+# 0 - ограничение на повторное прохождение отключено
+retake_cooldown_hours = float(os.getenv('RETAKE_COOLDOWN_HOURS', '0'))
+sessions_max_size = int(os.getenv('SESSIONS_MAX_SIZE', '10000'))
+sessions_idle_ttl = int(os.getenv('SESSIONS_IDLE_TTL', str(24 * 3600)))
+# sqlite - состояние переживает перезапуск, memory - только в памяти процесса.
+# Состояние кэшируется в памяти процесса: при нескольких процессах с общей базой
+# обновления одного чата должны приходить в один процесс (маршрутизация по chat_id)
+storage_kind = os.getenv('SESSION_STORAGE', 'sqlite')
+storage_path = os.getenv('SESSION_DB_PATH', 'bot_state.sqlite3')
+storage_flush_interval = float(os.getenv('STORAGE_FLUSH_INTERVAL', '1'))
+generation_workers = int(os.getenv('GENERATION_WORKERS', '2'))
+outbound_global_rate = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+outbound_chat_rate = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+outbound_chat_burst = int(os.getenv('OUTBOUND_CHAT_BURST', '5'))
+# Рассылки: реестр пользователей в SQLite, часть глобального лимита OUTBOUND_GLOBAL_RATE остаётся для ответов
+broadcast_db_path = os.getenv('BROADCAST_DB_PATH', 'bot_state.sqlite3')
+broadcast_rate = float(os.getenv('BROADCAST_RATE', '25'))
+broadcast_workers = int(os.getenv('BROADCAST_WORKERS', '10'))
+# Оповещать всех пользователей о новых тестах после генерации
+broadcast_new_tests = os.getenv('BROADCAST_NEW_TESTS', '0') == '1'
+# Лимит Telegram на длину сообщения и запас под заголовок "Страница N/M" в show_guidelines
+message_limit = 4096
+page_header_reserve = 32
+webhook_url = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com/webhook
+webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+webhook_port = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Без WEBHOOK_URL секрет обязателен, с WEBHOOK_URL при пустом значении генерируется при запуске
+webhook_secret = os.getenv('WEBHOOK_SECRET')
+webhook_max_inflight = int(os.getenv('WEBHOOK_MAX_INFLIGHT', '100'))
+# Эндпоинт метрик Prometheus: http://METRICS_HOST:METRICS_PORT/metrics, 0 - отключён
+metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+metrics_port = int(os.getenv('METRICS_PORT', '0'))
+# Повторное нажатие той же кнопки в течение стольких секунд отбрасывается, 0 - не отбрасывать
+debounce_window = float(os.getenv('DEBOUNCE_WINDOW', '1'))
+# Администраторы, которым доступна команда /stats: ID через запятую
+admin_ids = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if admin_id}
+stats_sheet = os.getenv('STATS_SHEET', 'Stats')
+stats_flush_interval = float(os.getenv('STATS_FLUSH_INTERVAL', '300'))
+# Доля верных ответов, с которой тест считается сданным
+pass_score_ratio = float(os.getenv('PASS_SCORE_RATIO', '0.6'))
+# Сколько страниц показывать в ответе на /search
+search_results_limit = int(os.getenv('SEARCH_RESULTS_LIMIT', '8'))
+# stateless - прохождение теста хранится в callback_data кнопок, session - в сессии чата
+quiz_mode = os.getenv('QUIZ_MODE', 'session')
+# Ключ подписи кнопок теста, по умолчанию выводится из токена бота
+quiz_secret = os.getenv('QUIZ_SECRET') or f'quiz:{token}'
 logging.basicConfig(level=logging.INFO)
-def bot_init():
-    bot = Bot(token=token)
-    dp = Dispatcher()
-    service = get_service()
-    def get_menu_type(menu_type: str, page:int=1):
+def bot_init(service_factory=get_service, session=None):
+    """
+    Создаёт бота и диспетчер
+    Args:
+        service_factory: функция создания сервиса Google Sheets (для тестов - фейковый сервис)
+        session: HTTP-сессия aiogram (по умолчанию стандартная)
+    """
+    bot = Bot(token=token, session=session)
+    bot.session.middleware(TelegramTimer())
+    # Все сообщения уходят через общий слой с ограничением частоты
+    outbound = Outbound(bot, global_rate=outbound_global_rate, chat_rate=outbound_chat_rate,
+                        chat_burst=outbound_chat_burst)
+    storage_backend = create_backend(storage_kind, storage_path)
+    dp = Dispatcher(storage=BackendFSMStorage(storage_backend, max_size=sessions_max_size, idle_ttl=sessions_idle_ttl))
+    # Обновления одного чата обрабатываются по очереди, двойные нажатия отсеиваются
+    dp.update.outer_middleware(ChatSerializer(debounce=debounce_window))
+    user_registry = UserRegistry(broadcast_db_path)
+    dp.update.outer_middleware(UserTracker(user_registry))
+    broadcaster = Broadcaster(outbound, user_registry, rate=min(broadcast_rate, outbound_global_rate),
+                              workers=broadcast_workers)
+    session_store = SessionStore(max_size=sessions_max_size, idle_ttl=sessions_idle_ttl, backend=storage_backend)
+    async def generate_for_topic(topic):
+        # Тексты берутся из кэша, обращение к модели выполняется вне потока событий
+        guidelines = await guideline_cache.get(topic)
+        tests = await asyncio.to_thread(build_tests, guidelines)
+        if tests:
+            await test_bank.write_tests(topic, tests)
+            # Одно оповещение на задание генерации, сколько бы чатов его ни ждало
+            if broadcast_new_tests:
+                await broadcaster.submit(f"Доступен новый тест по теме '{topic}'")
+        return tests
+
+    generation_queue = GenerationQueue(generate_for_topic, workers=generation_workers)
+    callbacks = CallbackRouter()
+    callbacks.attach(dp.callback_query)
+    quiz_codec = QuizCodec(hashlib.sha256(quiz_secret.encode('utf-8')).digest())
+    handler_timer = HandlerTimer(callbacks)
+    dp.message.middleware(handler_timer)
+    dp.callback_query.middleware(handler_timer)
+    storage_flusher = StorageFlusher(storage_backend, [session_store, dp.storage, user_registry],
+                                     interval=storage_flush_interval, idle_ttl=sessions_idle_ttl)
+    sheets = AsyncSheets(service_factory, max_workers=sheets_workers,
+                         requests_per_minute=sheets_requests_per_minute, burst=sheets_burst,
+                         batch_window=sheets_batch_window)
+    guideline_cache = GuidelineCache(sheets, spreadsheet, 'Лист1', ttl=guidelines_ttl)
+    test_bank = TestBank(sheets, spreadsheet, 'Лист2', ttl=tests_ttl)
+    topic_catalog = TopicCatalog(guideline_cache, test_bank)
+    # Страницы индекса совпадают со страницами show_guidelines
+    guideline_index = GuidelineIndex(guideline_cache, message_limit - page_header_reserve)
+    results_writer = ResultWriter(sheets, results_spreadsheet, results_sheet, results_spool,
+                                  batch_size=results_batch_size, flush_interval=results_flush_interval)
+    attempt_index = AttemptIndex(sheets, results_spreadsheet, results_sheet, ttl=tests_ttl)
+    results_writer.add_listener(attempt_index.record)
+    score_stats = ScoreStats(sheets, results_spreadsheet, results_sheet, stats_sheet, pass_ratio=pass_score_ratio,
+                             flush_interval=stats_flush_interval)
+    results_writer.add_listener(score_stats.record)
+    metrics_runner = None
+    background_tasks = []
+    first_response = None
+
+    async def warm_up():
+        # Токен, сервисы в потоках пула и кэши готовятся в фоне, пока диспетчер уже принимает обновления
+        try:
+            if service_factory is sheets_api.get_service:
+                await asyncio.to_thread(sheets_api.refresh_credentials)
+                background_tasks.append(asyncio.create_task(keep_credentials_fresh()))
+            await sheets.warm_up()
+            guideline_cache.start()
+            test_bank.start()
+            # Оба листа читаются одним batchGet
+            await asyncio.gather(guideline_cache.wait_loaded(), test_bank.wait_loaded())
+            mark_startup('sheets_warm')
+            await guideline_index.refresh()
+        except Exception as e:
+            logging.warning(f"Не удалось прогреть Google Sheets при запуске: {e}")
+            guideline_cache.start()
+            test_bank.start()
+
+    @dp.update.outer_middleware()
+    async def report_first_response(handler, event, data):
+        nonlocal first_response
+        result = await handler(event, data)
+        if first_response is None:
+            first_response = mark_startup('first_response')
+        return result
+
+    @dp.startup()
+    async def on_startup():
+        nonlocal metrics_runner
+        if metrics_port:
+            metrics_runner = await start_metrics_server(metrics_host, metrics_port)
+        background_tasks.append(asyncio.create_task(warm_up()))
+        results_writer.start()
+        score_stats.start()
+        if retake_cooldown_hours:
+            attempt_index.start()
+        storage_flusher.start()
+        generation_queue.start()
+        broadcaster.start()
+        mark_startup('dispatcher_ready')
+
+    @dp.shutdown()
+    async def on_shutdown():
+        for task in background_tasks:
+            task.cancel()
+        await guideline_cache.stop()
+        await test_bank.stop()
+        await results_writer.stop()
+        await score_stats.stop()
+        await attempt_index.stop()
+        await generation_queue.stop()
+        await broadcaster.stop()
+        await storage_flusher.stop()
+        user_registry.close()
+        sheets.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+    def get_menu_type(menu_type: str, page:int=1, topics=()):
         keyboard = InlineKeyboardBuilder()
         if menu_type == 'main':
             keyboard.add(
@@ -27,18 +222,14 @@ def bot_init():
             )
             keyboard.adjust(1)
         elif menu_type == 'testing' or menu_type == 'guidelines' or menu_type == 'generate_test':
-            topics = [
-                "Тема 1", "Тема 2", "Тема 3", "Тема 4",
-                "Тема 5", "Тема 6", "Тема 7", "Тема 8"
-            ]
             items_per_page = 4
             start = (page - 1) * items_per_page
             end = start + items_per_page
             page_topics = topics[start:end]
 
             for topic in page_topics:
-                keyboard.add(InlineKeyboardButton(text=topic, callback_data=f'{menu_type}_topic:{topic}'))
-                keyboard.adjust(2)
+                keyboard.add(InlineKeyboardButton(text=topic, callback_data=callbacks.pack(f'{menu_type}_topic',
+                                                                                           topic_key(topic))))
             # Добавляем кнопки управления страницами
             if page > 1:
                 keyboard.add(InlineKeyboardButton(text='⬅️', callback_data=f'{menu_type}_page:{page - 1}'))
@@ -46,66 +237,151 @@ def bot_init():
                 keyboard.add(InlineKeyboardButton(text='➡️', callback_data=f'{menu_type}_page:{page + 1}'))
             keyboard.adjust(2)
             keyboard.add(InlineKeyboardButton(text='Назад', callback_data='back_previous'))
-
-        elif menu_type == 'guideline_pages':
-            keyboard.add(
-                InlineKeyboardButton(text='⬅️', callback_data='guideline_prev'),
-                InlineKeyboardButton(text='➡️', callback_data='guideline_next')
-            )
-            keyboard.add(InlineKeyboardButton(text='Назад', callback_data='back_previous'))
         return keyboard
 
+    # Готовые клавиатуры меню общие для всех чатов: (menu_type, page, версия листа) -> разметка
+    menu_markups = {}
+    # Откуда берутся темы меню: тестирование - темы с тестами, остальные - темы с методическими указаниями.
+    # Главное меню тем не содержит и не зависит от доступности таблиц
+    menu_sources = {'testing': test_bank, 'guidelines': guideline_cache, 'generate_test': guideline_cache}
+
+    async def get_menu_markup(menu_type: str, page: int = 1):
+        source = menu_sources.get(menu_type)
+        if source is None:
+            topics, version = (), None
+        else:
+            topics = tuple(await source.topics())
+            version = source.version
+        key = (menu_type, page, version)
+        markup = menu_markups.get(key)
+        if markup is None:
+            for cached_key in [cached_key for cached_key in menu_markups
+                               if cached_key[0] == menu_type and cached_key[2] != version]:
+                del menu_markups[cached_key]
+            markup = get_menu_type(menu_type, page, topics).as_markup()
+            menu_markups[key] = markup
+        return markup
+
     class MenuKeeper:
         def __init__(self):
-            self.menu_message_id = None
-            self.chat_ids = {}  # Для работы с несколькими чатами
-            self.guideline_message_ids = {}
-            self.test_sessions = {}
-            self.current_menu = {}  # Текущее меню для каждого чата
-            self.menu_history = {}
-            self.saved_messages = {}
-
-        async def refresh_menu(self, chat_id: int, text: str = 'Меню', menu_type: str = 'main', page: int=1, update_history: bool = True):
+            # Состояние каждого чата хранится в отдельной сессии,
+            # неактивные сессии вытесняются
+            self.sessions = session_store
+
+        def session(self, chat_id: int):
+            return self.sessions.get(chat_id)
+
+        async def refresh_menu(self, chat_id: int, text: str = 'Меню', menu_type: str = 'main', page: int=1, update_history: bool = True, message_id: int = None,
+                               new_message: bool = False):
+            """
+            Показывает меню, по возможности редактируя текущее сообщение меню чата
+            Args:
+                new_message: удалить текущее меню и отправить новое сообщение (например, на /start),
+                    даже если текущее меню уже показывает то же самое
+            """
             try:
-                if update_history:
-                    if chat_id not in self.menu_history:
-                        self.menu_history[chat_id] = []
-                    if self.current_menu.get(chat_id) is not None:
-                        self.menu_history[chat_id].append(self.current_menu[chat_id])
+                session = self.sessions.get(chat_id)
+                if update_history and session.current_menu is not None:
+                    session.menu_history.append(session.current_menu)
 
                 # Получаем клавиатуру для меню
-                keyboard = get_menu_type(menu_type, page)
+                markup = await get_menu_markup(menu_type, page)
+
+                # Сообщение, из которого пришло нажатие, и есть текущее меню чата
+                if message_id is not None:
+                    session.menu_message_id = message_id
 
-                # Если меню уже существует и его ID совпадает с сохраненным
-                if self.menu_message_id:
+                if session.menu_message_id and new_message:
+                    try:
+                        await outbound.delete_message(chat_id, session.menu_message_id)
+                    except Exception:
+                        pass
+                elif session.menu_message_id:
                     # Пробуем обновить текущее меню (если оно существует)
                     try:
-                        await bot.edit_message_text(
+                        await outbound.edit_message_text(
                             chat_id=chat_id,
-                            message_id=self.menu_message_id,
+                            message_id=session.menu_message_id,
                             text=text,
-                            reply_markup=keyboard.as_markup()
+                            reply_markup=markup
                         )
-                        self.current_menu[chat_id] = menu_type
-                        # Меню уже актуально, ничего не делаем
+                        session.current_menu = menu_type
                         return
                     except Exception:
                         try:
-                            await bot.delete_message(chat_id, self.menu_message_id)
+                            await outbound.delete_message(chat_id, session.menu_message_id)
                         except Exception:
                             pass
 
-                msg = await bot.send_message(chat_id, text, reply_markup=keyboard.as_markup())
-                self.menu_message_id = msg.message_id
-                self.current_menu[chat_id] = menu_type
-            except Exception as e:
-                print(f"Ошибка при обновлении меню: {e}")
+                msg = await outbound.send_message(chat_id, text, reply_markup=markup)
+                session.menu_message_id = msg.message_id
+                session.current_menu = menu_type
+            except Exception:
+                logging.exception(f"Ошибка при обновлении меню в чате {chat_id}")
 
     menu_keeper = MenuKeeper()
 
+    BOT_GAUGES.set_function(lambda: len(menu_keeper.sessions), store='sessions')
+    BOT_GAUGES.set_function(lambda: menu_keeper.sessions.unsaved, store='sessions_unsaved')
+    BOT_GAUGES.set_function(lambda: dp.storage.cached, store='fsm_records')
+    BOT_GAUGES.set_function(lambda: len(menu_markups), store='menu_markups')
+    BOT_GAUGES.set_function(lambda: len(results_writer), store='results_pending')
+    BOT_GAUGES.set_function(lambda: len(generation_queue), store='generation_jobs')
+    BOT_GAUGES.set_function(lambda: user_registry.active, store='users')
+
     @dp.message(Command('start'))
     async def cmd_start(message: Message):
-        await menu_keeper.refresh_menu(message.chat.id)
+        # Меню всегда приходит новым сообщением: старое могло остаться далеко в истории чата
+        await menu_keeper.refresh_menu(message.chat.id, new_message=True)
+
+    @dp.message(Command('stats'))
+    async def cmd_stats(message: Message):
+        """/stats - сводка по всем темам, /stats <тема> - подробно по теме (только для ADMIN_IDS)"""
+        if message.from_user is None or message.from_user.id not in admin_ids:
+            return
+        topics = await score_stats.topics()
+        topic = (message.text or '').partition(' ')[2].strip()
+        text = format_topic(topic, topics.get(topic)) if topic else format_overview(topics, message_limit)
+        await outbound.send_message(message.chat.id, text)
+
+    @dp.message(Command('broadcast'))
+    async def cmd_broadcast(message: Message):
+        """/broadcast <текст> - рассылка всем пользователям бота (только для ADMIN_IDS)"""
+        if message.from_user is None or message.from_user.id not in admin_ids:
+            return
+        text = (message.text or '').partition(' ')[2].strip()
+        if not text:
+            await outbound.send_message(message.chat.id, "Введите текст рассылки после команды")
+            return
+        progress = await outbound.send_message(message.chat.id, "Рассылка поставлена в очередь...")
+        await broadcaster.submit(text, message.chat.id, progress.message_id)
+
+    @dp.message(Command('search'))
+    async def cmd_search(message: Message):
+        """/search <запрос> - поиск по методическим указаниям с переходом к найденной странице"""
+        query = (message.text or '').partition(' ')[2].strip()
+        if not query:
+            await outbound.send_message(message.chat.id, "Введите запрос после команды, например: /search базы данных")
+            return
+        hits = await guideline_index.search(query, search_results_limit)
+        keyboard = InlineKeyboardBuilder()
+        lines = []
+        for topic, page_index in hits:
+            try:
+                data = callbacks.pack('search_hit', page_index, topic)
+            except ValueError:
+                continue
+            pages = await guideline_cache.pages(topic, message_limit - page_header_reserve)
+            if page_index >= len(pages):
+                continue
+            lines.append(f"{len(lines) + 1}. {topic}, стр. {page_index + 1}: {snippet(pages[page_index], query)}")
+            keyboard.add(InlineKeyboardButton(text=f"{len(lines)}. {topic}, стр. {page_index + 1}", callback_data=data))
+        if not lines:
+            await outbound.send_message(message.chat.id, f"По запросу «{query}» ничего не найдено")
+            return
+        keyboard.adjust(1)
+        await outbound.send_message(message.chat.id, f"Результаты поиска «{query}»:\n\n" + '\n\n'.join(lines),
+                                    reply_markup=keyboard.as_markup())
 
     def process_guideline_material(material):
         """
@@ -118,220 +394,281 @@ def bot_init():
         # Здесь можно добавить вызов нейросети для обработки материала
         return material
 
-    async def show_question(chat_id,message_id):
-        session = menu_keeper.test_sessions[chat_id]
-        current_index = session["current_index"]
-        question = session["questions"][current_index]
+    async def get_test_session(callback_query: CallbackQuery):
+        session = menu_keeper.session(callback_query.message.chat.id).test
+        if session is None:
+            await outbound.send_message(callback_query.message.chat.id, "Тест не найден, начните его заново")
+        return session
 
-        # Генерация клавиатуры
+    # callback_data кнопок теста в режиме с состоянием в сессии чата
+    session_buttons = {ACTION_GOTO: 'question:{}', ACTION_ANSWER: 'answer:{}',
+                       ACTION_SHOW: 'show_answer', ACTION_FINISH: 'finish_test'}
+
+    def question_text(questions, index):
+        return f"Вопрос {index + 1} из {len(questions)}\n\n{questions[index]['question']}"
+
+    def question_markup(questions, index, current_answer, button_data):
+        """
+        Клавиатура вопроса
+        Args:
+            current_answer: выбранный ответ или None, если кнопку "Ваш ответ" показывать не нужно
+            button_data: функция button_data(действие, аргумент), возвращающая callback_data
+        """
         keyboard = InlineKeyboardBuilder()
 
-        for i, option in enumerate(question["options"]):
-            keyboard.add(InlineKeyboardButton(text=option, callback_data=f"answer:{i}"))
+        for i, option in enumerate(questions[index]["options"]):
+            keyboard.add(InlineKeyboardButton(text=option, callback_data=button_data(ACTION_ANSWER, i)))
         keyboard.adjust(2)
-        if current_index > 0:
-            keyboard.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="prev_question"))
-        if current_index < len(session["questions"]) - 1:
-            keyboard.add(InlineKeyboardButton(text="➡️ Далее", callback_data="next_question"))
+        if index > 0:
+            keyboard.add(InlineKeyboardButton(text="⬅️ Назад", callback_data=button_data(ACTION_GOTO, index - 1)))
+        if index < len(questions) - 1:
+            keyboard.add(InlineKeyboardButton(text="➡️ Далее", callback_data=button_data(ACTION_GOTO, index + 1)))
         keyboard.adjust(2)
-        if current_index == len(session["questions"]) - 1:
-            keyboard.add(InlineKeyboardButton(text="Завершить", callback_data="finish_test"))
+        if index == len(questions) - 1:
+            keyboard.add(InlineKeyboardButton(text="Завершить", callback_data=button_data(ACTION_FINISH, 0)))
 
         # Добавляем кнопку для показа выбранного ответа
-        if current_index < len(session["answers"]):
-            current_answer = session["answers"][current_index]
-            keyboard.add(InlineKeyboardButton(text=f"Ваш ответ: {current_answer}", callback_data="show_answer"))
+        if current_answer is not None:
+            keyboard.add(InlineKeyboardButton(text=f"Ваш ответ: {current_answer}",
+                                              callback_data=button_data(ACTION_SHOW, 0)))
+        return keyboard.as_markup()
+
+    async def show_question(chat_id,message_id):
+        session = menu_keeper.session(chat_id).test
+        current_index = session["current_index"]
+        answers = session["answers"]
+        markup = question_markup(session["questions"], current_index,
+                                 answers[current_index] if current_index < len(answers) else None,
+                                 lambda action, arg: session_buttons[action].format(arg))
 
         # Отправляем вопрос
-        await bot.edit_message_text(
+        await outbound.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
-            text=f"Вопрос {current_index + 1} из {len(session['questions'])}\n\n{question['question']}",
-            reply_markup = keyboard.as_markup()
+            text=question_text(session["questions"], current_index),
+            reply_markup=markup
+        )
+
+    def quiz_markup(chat_id, variant, fingerprint, questions, index, answers):
+        """
+        Клавиатура вопроса, в кнопки которой закодировано всё прохождение теста
+        Raises:
+            ValueError: состояние не помещается в callback_data
+        """
+        def button_data(action, arg):
+            return callbacks.pack('q', quiz_codec.pack(chat_id, variant, fingerprint, questions,
+                                                       index, answers, action, arg))
+        return question_markup(questions, index, answers[index] or None, button_data)
+
+    async def show_result(callback_query: CallbackQuery, topic, questions, answers):
+        """Подсчитывает баллы, ставит результат в очередь записи и показывает его"""
+        is_correct = [user_answer == q["answer"] for q, user_answer in zip(questions, answers)]
+        correct = sum(is_correct)
+
+        # Результат уходит в очередь записи, таблица не задерживает ответ
+        await results_writer.submit(make_result_row(
+            callback_query.from_user.id, topic,
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'), answers, correct, is_correct
+        ))
+
+        # Показываем результат
+        keyboard = InlineKeyboardBuilder()
+        keyboard.add(InlineKeyboardButton(text="К темам", callback_data="menu_testing"))
+        await outbound.edit_message_text(
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            text=f"Ваш результат: {correct} из {len(questions)}",
+            reply_markup=keyboard.as_markup()
         )
 
     async def show_guidelines(chat_id,message_id):
-        session = menu_keeper.guideline_message_ids[chat_id]
-        current_index = session["current"]
-        page = session["pages"][current_index]
+        session = menu_keeper.session(chat_id).guideline
+        # Страницы общие для всех чатов, в сессии только тема и позиция
+        pages = await guideline_cache.pages(session["topic"], message_limit - page_header_reserve)
+        if not pages:
+            return
+        current_index = min(session["current"], len(pages) - 1)
+        session["current"] = current_index
+        page = pages[current_index]
 
         # Формируем текст с номером страницы
-        text = f"Страница {current_index + 1}/{len(session['pages'])}\n\n{page}"
+        text = f"Страница {current_index + 1}/{len(pages)}\n\n{page}"
 
         # Создаем клавиатуру
         keyboard = InlineKeyboardBuilder()
         if current_index > 0:
-            keyboard.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="guideline_prev"))
-        if current_index < len(session["pages"]) - 1:
-            keyboard.add(InlineKeyboardButton(text="➡️ Далее", callback_data="guideline_next"))
+            keyboard.add(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"guideline_page:{current_index - 1}"))
+        if current_index < len(pages) - 1:
+            keyboard.add(InlineKeyboardButton(text="➡️ Далее", callback_data=f"guideline_page:{current_index + 1}"))
         keyboard.adjust(2)
         keyboard.add(InlineKeyboardButton(text="Назад к темам", callback_data="back_to_topics"))
         keyboard.adjust(2)
 
         # Отправляем/обновляем сообщение
-        await bot.edit_message_text(
+        await outbound.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
             text=text,
             reply_markup=keyboard.as_markup()
         )
-    def has_user_passed_test(service, spreadsheet_id, sheet_name, tg_id, topic):
-        """
-        Проверяет, проходил ли пользователь тест по данной теме
-        Args:
-            service: сервис Google Sheets
-            spreadsheet_id: ID таблицы
-            sheet_name: имя листа
-            tg_id: ID пользователя
-            topic: тема теста
-        Returns:
-            True, если пользователь уже проходил тест, иначе False
-        """
-        range_name = f'{sheet_name}!A:E'  # Предполагаем, что данные хранятся в колонках A-E
-        data = read_sheet(service, spreadsheet_id, range_name)
 
-        for row in data:
-            if len(row) > 1 and row[1] == topic and row[0] == str(tg_id):
-                return True
-        return False
-
-    def can_user_retake_test(service, spreadsheet_id, sheet_name, tg_id, topic):
+    async def can_user_retake_test(tg_id, topic):
         """
         Проверяет, может ли пользователь перепройти тест
         Args:
-            service: сервис Google Sheets
-            spreadsheet_id: ID таблицы
-            sheet_name: имя листа
             tg_id: ID пользователя
             topic: тема теста
         Returns:
-            True, если прошло 24 часа с момента последнего прохождения, иначе False
+            True, если с момента последнего прохождения прошло retake_cooldown_hours часов, иначе False
         """
-        range_name = f'{sheet_name}!A:E'  # Предполагаем, что данные хранятся в колонках A-E
-        data = read_sheet(service, spreadsheet_id, range_name)
-
-        for row in data:
-            if len(row) > 1 and row[1] == topic and row[0] == str(tg_id):
-                last_passed_date = datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S')
-                if datetime.now() - last_passed_date < timedelta(hours=24):
-                    return False
-        return True
+        last_passed_date = await attempt_index.last_attempt(tg_id, topic)
+        if last_passed_date is None:
+            return True
+        return datetime.now() - last_passed_date >= timedelta(hours=retake_cooldown_hours)
 
-    @dp.callback_query(lambda c: c.data == 'menu_testing')
+    @callbacks.route('menu_testing')
     async def menu_testing_callback(callback_query: CallbackQuery):
         await callback_query.answer()
-        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Выберите тему для тестирования', menu_type='testing', page=1, update_history=False)
+        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Выберите тему для тестирования', menu_type='testing', page=1, update_history=False,
+                                       message_id=callback_query.message.message_id)
 
-    @dp.callback_query(lambda c: c.data == 'menu_guidelines')
+    @callbacks.route('menu_guidelines')
     async def menu_guidelines_callback(callback_query: CallbackQuery):
         await callback_query.answer()
-        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Методические указания',menu_type='guidelines', page=1)
+        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Методические указания',menu_type='guidelines', page=1,
+                                       message_id=callback_query.message.message_id)
 
-    @dp.callback_query(lambda c: c.data.startswith('testing_page'))
-    async def testing_page_callback(callback_query: CallbackQuery):
+    @callbacks.route('testing_page', page=int)
+    async def testing_page_callback(callback_query: CallbackQuery, page: int):
         await callback_query.answer()
-        _, page = callback_query.data.split(':')
-        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Выберите тему для тестирования', menu_type='testing', page=int(page), update_history=False)
+        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Выберите тему для тестирования', menu_type='testing', page=page, update_history=False,
+                                       message_id=callback_query.message.message_id)
 
-    @dp.callback_query(lambda c: c.data.startswith('guidelines_page'))
-    async def guidelines_page_callback(callback_query: CallbackQuery):
+    @callbacks.route('guidelines_page', page=int)
+    async def guidelines_page_callback(callback_query: CallbackQuery, page: int):
         await callback_query.answer()
-        _, page = callback_query.data.split(':')
-        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Методические указания', menu_type='guidelines', page=int(page), update_history=False)
+        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Методические указания', menu_type='guidelines', page=page, update_history=False,
+                                       message_id=callback_query.message.message_id)
 
-    @dp.callback_query(lambda c: c.data == 'back_previous')
+    @callbacks.route('back_previous')
     async def process_back_previous_callback(callback_query: CallbackQuery):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
 
-        # Удаляем сообщения МУ, если они есть
-        if chat_id in menu_keeper.guideline_message_ids:
-            for msg_id in menu_keeper.guideline_message_ids[chat_id]:
-                try:
-                    await bot.delete_message(chat_id, msg_id)
-                except Exception:
-                    pass
-            del menu_keeper.guideline_message_ids[chat_id]
+        session = menu_keeper.session(chat_id)
+
+        # Завершаем чтение МУ, если оно было
+        session.guideline = None
 
         # Получаем последнее меню из истории
-        if chat_id in menu_keeper.menu_history and menu_keeper.menu_history[chat_id]:
-            previous_menu = menu_keeper.menu_history[chat_id].pop()  # Удаляем последний элемент из истории
+        if session.menu_history:
+            previous_menu = session.menu_history.pop()  # Удаляем последний элемент из истории
         else:
             previous_menu = 'main'
-        await menu_keeper.refresh_menu(chat_id, menu_type=previous_menu,update_history=False)
-
-    @dp.callback_query(lambda c: c.data.startswith('guidelines_topic'))
-    async def send_guidelines(callback_query: CallbackQuery):
+        await menu_keeper.refresh_menu(chat_id, menu_type=previous_menu,update_history=False,
+                                       message_id=callback_query.message.message_id)
+
+    async def resolve_topic(callback_query: CallbackQuery, key: str):
+        """Тема по ключу из кнопки меню или None (тема удалена из таблиц, пользователь предупреждён)"""
+        topic = await topic_catalog.resolve(key)
+        if topic is None:
+            await callback_query.answer("Тема не найдена, откройте меню заново", show_alert=True)
+        return topic
+
+    @callbacks.route('guidelines_topic', key=str)
+    async def send_guidelines(callback_query: CallbackQuery, key: str):
+        topic = await resolve_topic(callback_query, key)
+        if topic is None:
+            return
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
-        topic = callback_query.data.split(':')[1]
 
-        # Получаем методические указания
-        guidelines = get_guidelines(service, spreadsheet, 'Лист1', topic)
-        if not guidelines:
-            await callback_query.message.answer("Методические указания отсутствуют")
+        # Получаем методические указания, уже разбитые на страницы
+        pages = await guideline_cache.pages(topic, message_limit - page_header_reserve)
+        if not pages:
+            await outbound.send_message(callback_query.message.chat.id, "Методические указания отсутствуют")
             return
 
-        # Разбиваем на страницы
-        pages = []
-        for guideline in guidelines:
-            pages.extend(split_into_pages(guideline))  # Используем вашу функцию разбиения
-
-        menu_keeper.guideline_message_ids[chat_id] = {
+        menu_keeper.session(chat_id).guideline = {
             'current': 0,
-            'pages': pages,
             'topic': topic
         }
 
         await show_guidelines(chat_id, message_id)
 
-    @dp.callback_query(lambda c: c.data in ['guideline_prev', 'guideline_next'])
-    async def handle_pagination(callback_query: CallbackQuery):
+    @callbacks.route('guideline_page', index=int)
+    async def handle_pagination(callback_query: CallbackQuery, index: int):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
-        direction = 1 if callback_query.data == 'guideline_next' else -1
-        if direction>0:
-            menu_keeper.guideline_message_ids[chat_id]["current"] += 1
-        else:
-            menu_keeper.guideline_message_ids[chat_id]["current"] -= 1
+        session = menu_keeper.session(chat_id).guideline
+        if session is None:
+            return
+        # Кнопка содержит номер целевой страницы, повторное нажатие ничего не сдвигает
+        session["current"] = max(index, 0)
         await show_guidelines(chat_id, message_id)
 
 
-    @dp.callback_query(lambda c: c.data == 'back_to_topics')
+    @callbacks.route('search_hit', index=int, topic=str)
+    async def open_search_hit(callback_query: CallbackQuery, index: int, topic: str):
+        await callback_query.answer()
+        chat_id = callback_query.message.chat.id
+        # Страница могла исчезнуть после обновления листа, show_guidelines покажет ближайшую
+        if not await guideline_cache.pages(topic, message_limit - page_header_reserve):
+            await outbound.send_message(chat_id, "Методические указания отсутствуют")
+            return
+        menu_keeper.session(chat_id).guideline = {
+            'current': max(index, 0),
+            'topic': topic
+        }
+        await show_guidelines(chat_id, callback_query.message.message_id)
+
+    @callbacks.route('back_to_topics')
     async def back_to_topics(callback_query: CallbackQuery):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
 
         # Возвращаемся к меню тем
-        await menu_keeper.refresh_menu(chat_id, menu_type='guidelines', page=1,update_history=False)
+        await menu_keeper.refresh_menu(chat_id, menu_type='guidelines', page=1,update_history=False,
+                                       message_id=callback_query.message.message_id)
 
-    @dp.callback_query(lambda c: c.data.startswith('testing_topic'))
-    async def start_test(callback_query: CallbackQuery):
+    @callbacks.route('testing_topic', key=str)
+    async def start_test(callback_query: CallbackQuery, key: str):
+        topic = await resolve_topic(callback_query, key)
+        if topic is None:
+            return
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
-        topic = callback_query.data.split(':')[1]
 
-        #if has_user_passed_test(service, 'TEST_SPREADSHEET_ID', 'UserAnswers', chat_id, topic):
-        #    await callback_query.message.answer(
-        #        "Вы уже проходили этот тест. Повторное прохождение будет доступно через 24 часа.")
-        #    return
-
-            # Проверяем, может ли пользователь перепройти тест
-        #if not can_user_retake_test(service, 'TEST_SPREADSHEET_ID', 'UserAnswers', chat_id, topic):
-        #    await callback_query.message.answer(
-        #        "Вы уже проходили этот тест. Повторное прохождение будет доступно через 24 часа.")
-        #    return
+        # Проверяем, может ли пользователь перепройти тест
+        if retake_cooldown_hours and not await can_user_retake_test(callback_query.from_user.id, topic):
+            await outbound.send_message(callback_query.message.chat.id,
+                f"Вы уже проходили этот тест. Повторное прохождение будет доступно через {retake_cooldown_hours:g} ч.")
+            return
 
-        tests = get_tests_for_topic(service, spreadsheet, 'Лист2', topic)
+        variant = await test_bank.pick(topic)
 
-        if not tests:
-            await callback_query.message.answer("Тесты по данной теме отсутствуют")
+        if not variant:
+            await outbound.send_message(callback_query.message.chat.id, "Тесты по данной теме отсутствуют")
             return
+        row_number, tests = variant
 
-        menu_keeper.test_sessions[chat_id] = {
+        if quiz_mode == 'stateless':
+            _, _, fingerprint = await test_bank.variant(row_number)
+            answers = (0,) * len(tests)
+            try:
+                markup = quiz_markup(chat_id, row_number, fingerprint, tests, 0, answers)
+            except ValueError:
+                logging.warning(f"Вариант теста в строке {row_number} не помещается в callback_data, "
+                                f"состояние теста хранится в сессии")
+            else:
+                await outbound.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                                 text=question_text(tests, 0), reply_markup=markup)
+                return
+
+        menu_keeper.session(chat_id).test = {
             "topic": topic,
             "questions": tests,
             "current_index": 0,
@@ -340,33 +677,30 @@ def bot_init():
 
         await show_question(chat_id,message_id)
 
-    @dp.callback_query(lambda c: c.data == "prev_question")
-    async def previous_question(callback_query: CallbackQuery):
-        await callback_query.answer()
-        chat_id = callback_query.message.chat.id
-        message_id = callback_query.message.message_id
-        menu_keeper.test_sessions[chat_id]["current_index"] -= 1
-        await show_question(chat_id,message_id)
-
-    @dp.callback_query(lambda c: c.data == "next_question")
-    async def next_question(callback_query: CallbackQuery):
+    @callbacks.route('question', index=int)
+    async def go_to_question(callback_query: CallbackQuery, index: int):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
 
-        session = menu_keeper.test_sessions[chat_id]
-        current_index = session["current_index"]
-        if len(session["answers"])<=current_index:
+        session = await get_test_session(callback_query)
+        if session is None:
+            return
+        index = min(max(index, 0), len(session["questions"]) - 1)
+        # При переходе вперёд пропущенные вопросы считаются без ответа
+        while len(session["answers"]) < index:
             session["answers"].append(0)
-        menu_keeper.test_sessions[chat_id]["current_index"] += 1
+        session["current_index"] = index
         await show_question(chat_id,message_id)
 
-    @dp.callback_query(lambda c: c.data == "show_answer")
+    @callbacks.route('show_answer')
     async def show_answer(callback_query: CallbackQuery):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
-        session = menu_keeper.test_sessions[chat_id]
+        session = await get_test_session(callback_query)
+        if session is None:
+            return
         current_index = session["current_index"]
 
         # Получаем текущий ответ пользователя
@@ -376,7 +710,7 @@ def bot_init():
             answer = "Ответ не выбран."
 
         # Отправляем сообщение с ответом
-        await bot.edit_message_text(
+        await outbound.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
             text=f"Вопрос {current_index + 1} из {len(session['questions'])}\n\n"
@@ -385,15 +719,16 @@ def bot_init():
             reply_markup=callback_query.message.reply_markup
         )
 
-    @dp.callback_query(lambda c: c.data.startswith('answer:'))
-    async def process_answer(callback_query: CallbackQuery):
+    @callbacks.route('answer', answer_index=int)
+    async def process_answer(callback_query: CallbackQuery, answer_index: int):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
-        answer_index = int(callback_query.data.split(':')[1])  # Получаем индекс ответа
 
         # Получаем текущую сессию теста
-        session = menu_keeper.test_sessions[chat_id]
+        session = await get_test_session(callback_query)
+        if session is None:
+            return
         current_index = session["current_index"]
 
         # Сохраняем ответ пользователя
@@ -405,63 +740,99 @@ def bot_init():
         # Обновляем сообщение с вопросом, чтобы показать выбранный ответ
         await show_question(chat_id, message_id)
 
-    @dp.callback_query(lambda c: c.data == "finish_test")
+    @callbacks.route('finish_test')
     async def finish_test(callback_query: CallbackQuery):
         await callback_query.answer()
         chat_id = callback_query.message.chat.id
-        message_id = callback_query.message.message_id
-        session = menu_keeper.test_sessions[chat_id]
+        session = menu_keeper.session(chat_id).test
 
         if not session:
-            await callback_query.message.answer("Ошибка тестирования")
+            await outbound.send_message(callback_query.message.chat.id, "Ошибка тестирования")
             return
 
-        # Подсчёт баллов
-        correct = 0
-        answers = []
-        for i, q in enumerate(session["questions"]):
-            user_answer = session["answers"][i] if i < len(session["answers"]) else None
-            answers.append(user_answer)
-            if user_answer == q["answer"]:
-                correct += 1
+        answers = [session["answers"][i] if i < len(session["answers"]) else None
+                   for i in range(len(session["questions"]))]
+        await show_result(callback_query, session["topic"], session["questions"], answers)
 
-        # Показываем результат
-        keyboard = InlineKeyboardBuilder()
-        keyboard.add(InlineKeyboardButton(text="К темам", callback_data="menu_testing"))
-        await bot.edit_message_text(
+        menu_keeper.session(chat_id).test = None
+
+    @callbacks.route('q', token=str)
+    async def quiz_callback(callback_query: CallbackQuery, token: str):
+        """Кнопки теста в режиме QUIZ_MODE=stateless: всё состояние приходит в callback_data"""
+        chat_id = callback_query.message.chat.id
+        message_id = callback_query.message.message_id
+        try:
+            row_number = quiz_codec.variant(token)
+            variant = await test_bank.variant(row_number)
+            if variant is None:
+                raise ValueError('Вариант теста не найден')
+            topic, questions, fingerprint = variant
+            index, answers, action, arg = quiz_codec.unpack(chat_id, token, fingerprint, questions)
+            if action == ACTION_ANSWER and arg >= len(questions[index]["options"]):
+                raise ValueError('Нет такого варианта ответа')
+        except ValueError:
+            await callback_query.answer("Тест устарел, начните его заново", show_alert=True)
+            return
+        await callback_query.answer()
+
+        if action == ACTION_FINISH:
+            await show_result(callback_query, topic, questions, [answer or None for answer in answers])
+            return
+
+        text = None
+        if action == ACTION_ANSWER:
+            answers = answers[:index] + (arg + 1,) + answers[index + 1:]
+        elif action == ACTION_GOTO:
+            index = min(arg, len(questions) - 1)
+        elif action == ACTION_SHOW:
+            text = f"{question_text(questions, index)}\n\nВаш текущий ответ: {answers[index] or 'Ответ не выбран.'}"
+
+        await outbound.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
-            text=f"Ваш результат: {correct} из {len(session['questions'])}",
-            reply_markup=keyboard.as_markup()
+            text=text or question_text(questions, index),
+            reply_markup=quiz_markup(chat_id, row_number, fingerprint, questions, index, answers)
         )
 
-        del menu_keeper.test_sessions[chat_id]
-
-    @dp.callback_query(lambda c: c.data == 'menu_generate_tests')
+    @callbacks.route('menu_generate_tests')
     async def menu_generate_tests_callback(callback_query: CallbackQuery):
         await callback_query.answer()
-        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Сгенерировать тест по теме',menu_type='generate_test', page=1)
+        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Сгенерировать тест по теме',menu_type='generate_test', page=1,
+                                       message_id=callback_query.message.message_id)
 
-    @dp.callback_query(lambda c: c.data.startswith('generate_test_page'))
-    async def generate_test_page_callback(callback_query: CallbackQuery):
+    @callbacks.route('generate_test_page', page=int)
+    async def generate_test_page_callback(callback_query: CallbackQuery, page: int):
         await callback_query.answer()
-        _, page = callback_query.data.split(':')
-        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Сгенерировать тест по теме', menu_type='generate_test', page=int(page),
-                                       update_history=False)
+        await menu_keeper.refresh_menu(callback_query.message.chat.id, text='Сгенерировать тест по теме', menu_type='generate_test', page=page,
+                                       update_history=False,
+                                       message_id=callback_query.message.message_id)
 
 
-    @dp.callback_query(lambda c: c.data.startswith('generate_test_topic'))
-    async def generate_and_send_tests(callback_query: CallbackQuery):
+    @callbacks.route('generate_test_topic', key=str)
+    async def generate_and_send_tests(callback_query: CallbackQuery, key: str):
+        topic = await resolve_topic(callback_query, key)
+        if topic is None:
+            return
         await callback_query.answer()
-        topic = callback_query.data.split(':')[1]
+        chat_id = callback_query.message.chat.id
 
-        # Генерация тестов (заглушка)
-        tests = generate_tests(service, spreadsheet, 'Лист1', topic)
+        # Генерация идёт в фоне, пользователь получает сообщение о ходе работы
+        if generation_queue.is_pending(topic):
+            text = f"Генерация тестов по теме '{topic}' уже выполняется, результат придёт сюда."
+        else:
+            text = f"Генерация тестов по теме '{topic}' поставлена в очередь..."
+        progress = await outbound.send_message(callback_query.message.chat.id, text)
 
-        # Запись тестов в таблицу
-        write_tests_to_sheet(service, spreadsheet, 'Лист2', topic, tests)
+        async def report(tests, error):
+            if error is not None:
+                text = f"Не удалось сгенерировать тесты по теме '{topic}'."
+            elif not tests:
+                text = f"Методические указания по теме '{topic}' отсутствуют, тесты не сгенерированы."
+            else:
+                text = f"Тесты по теме '{topic}' сгенерированы и записаны в таблицу."
+            await outbound.edit_message_text(chat_id=chat_id, message_id=progress.message_id, text=text)
 
-        await callback_query.message.answer(f"Тесты по теме '{topic}' сгенерированы и записаны в таблицу.")
+        generation_queue.submit(topic, report)
 
     return bot, dp
 
@@ -471,4 +842,88 @@ async def start(bot:Bot,dp:Dispatcher):
     try:
         await dp.start_polling(bot)
     finally:
-        await bot.session.close()
\ No newline at end of file
+        await bot.session.close()
+
+
+def create_webhook_app(bot: Bot, dp: Dispatcher, path: str = webhook_path, secret: str = webhook_secret,
+                       max_inflight: int = webhook_max_inflight):
+    """
+    Создаёт aiohttp-приложение, принимающее обновления Telegram
+
+    Проверяет заголовок X-Telegram-Bot-Api-Secret-Token (секрет обязателен:
+    без него любой POST на path попадал бы в диспетчер), сразу отвечает 200 и
+    обрабатывает обновление в фоне. Одновременно обрабатывается не больше
+    max_inflight обновлений, следующие запросы ждут свободного места.
+
+    Для локальной проверки достаточно отправить сохранённое обновление:
+        curl -X POST -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' \\
+             -H 'Content-Type: application/json' -d @update.json localhost:8080/webhook
+    """
+    if not secret:
+        raise ValueError('Для webhook нужен секрет: задайте WEBHOOK_SECRET')
+    inflight = asyncio.Semaphore(max_inflight)
+    tasks = set()
+
+    async def process_update(update: Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.exception(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        finally:
+            inflight.release()
+
+    async def handle(request: web.Request):
+        if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': bot})
+        except ValueError:
+            return web.Response(status=400)
+        await inflight.acquire()
+        task = asyncio.create_task(process_update(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response()
+
+    async def on_cleanup(app: web.Application):
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def start_webhook(bot: Bot, dp: Dispatcher):
+    """
+    Запуск бота в режиме webhook (BOT_MODE=webhook)
+
+    Если задан WEBHOOK_URL, а WEBHOOK_SECRET нет, секрет генерируется и
+    передаётся в set_webhook. SIGTERM и SIGINT штатно останавливают бота:
+    выполняется on_shutdown (запись спула результатов, сессий и FSM).
+    """
+    secret = webhook_secret
+    if not secret and webhook_url:
+        secret = secrets.token_urlsafe(32)
+    runner = web.AppRunner(create_webhook_app(bot, dp, secret=secret))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await dp.emit_startup(bot=bot)
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, webhook_host, webhook_port).start()
+        if webhook_url:
+            await bot.set_webhook(webhook_url, secret_token=secret,
+                                  max_connections=min(webhook_max_inflight, 100))
+        logging.info(f"Webhook слушает {webhook_host}:{webhook_port}{webhook_path}")
+        await stop.wait()
+        logging.info("Получен сигнал остановки, бот завершает работу")
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()